@@ -0,0 +1,33 @@
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+import hashlib
+
+def make_etag(*parts):
+    """Strong ETag derived from whatever identifies the current representation."""
+    return '"' + hashlib.sha1(repr(parts).encode()).hexdigest()[:20] + '"'
+
+def validator_headers(etag, last_modified=None):
+    # no-cache lets browsers keep the body but revalidate it on every use.
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(last_modified.replace(tzinfo=timezone.utc), usegmt=True)
+    return headers
+
+def not_modified(request, etag, last_modified=None):
+    """Whether the request's validators still match (RFC 7232, If-None-Match wins)."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    # HTTP dates have second resolution.
+    return last_modified.replace(tzinfo=timezone.utc, microsecond=0) <= since
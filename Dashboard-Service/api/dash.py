@@ -1,28 +1,169 @@
-from fastapi import APIRouter, HTTPException, Query
-from typing import Literal
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from typing import List, Literal, NamedTuple, Optional
+from datetime import date
 from model.dashboard_model import DashboardResponse
-from database.mongodb import get_dashboard_data
+from database.mongodb import PERIOD_NAMES, get_dashboard_data, get_dashboard_version, iterate_dashboards, update_one, find_one
+from api.conditional import make_etag, not_modified, validator_headers
+from cache.dashboard_cache import dashboard_cache, DASHBOARD_CACHE_WARMUP
+from event.dashboard_grabber import MONGODB_COLLECTION_SYNC, SYNC_STATE_ID
+import logging
+import orjson
+import os
 
 router = APIRouter()
 
+CACHE_STATE_ID = "dashboard_cache"
+DASHBOARD_BATCH_MAX_HOTELS = int(os.getenv("DASHBOARD_BATCH_MAX_HOTELS", 500))
+DASHBOARD_BATCH_MAX_YEARS = int(os.getenv("DASHBOARD_BATCH_MAX_YEARS", 10))
+
+logger = logging.getLogger(__name__)
+
+class DashboardQuery(NamedTuple):
+    period: str
+    include_detail: bool = True
+    detail_for: Optional[str] = None
+    start: Optional[str] = None
+    end: Optional[str] = None
+    limit: int = 100
+    offset: int = 0
+
+async def dashboard_validators(hotel_id, query, year):
+    updated_at, generation = await get_dashboard_version(hotel_id, year)
+    return make_etag(hotel_id, tuple(query), year, updated_at, generation), updated_at
+
+async def render_dashboard(hotel_id, query, year, request=None):
+    key = (hotel_id, query, year)
+    entry = dashboard_cache.get(key)
+    if entry is None:
+        # Read the generation first: if the grabber writes while we load, the
+        # stale response is not stored.
+        generation = dashboard_cache.generation(hotel_id, year)
+        etag, last_modified = await dashboard_validators(hotel_id, query, year)
+        if request is not None and not_modified(request, etag, last_modified):
+            # The client already has this version, so the view is not read at all.
+            return Response(status_code=304, headers=validator_headers(etag, last_modified))
+        options = query._asdict()
+        options["start"] = date.fromisoformat(query.start) if query.start else None
+        options["end"] = date.fromisoformat(query.end) if query.end else None
+        body = orjson.dumps(await get_dashboard_data(hotel_id, year=year, **options))
+        entry = (body, etag, last_modified)
+        dashboard_cache.put(key, generation, entry)
+
+    body, etag, last_modified = entry
+    headers = validator_headers(etag, last_modified)
+    if request is not None and not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+async def warm_up_dashboard_cache():
+    state = await find_one(MONGODB_COLLECTION_SYNC, {"_id": CACHE_STATE_ID})
+    keys = (state or {}).get("keys", [])[:DASHBOARD_CACHE_WARMUP]
+    for hotel_id, query, year in keys:
+        try:
+            await render_dashboard(hotel_id, DashboardQuery(*query), year)
+        except Exception as e:
+            logger.error(f"Failed to warm up dashboard {hotel_id}/{query}/{year}: {str(e)}")
+    # Warm-up loads are not real requests and should not skew the ranking.
+    dashboard_cache.requests.clear()
+    logger.info(f"Warmed up {len(keys)} dashboard responses")
+
+async def save_dashboard_cache_keys():
+    keys = [[hotel_id, list(query), year] for hotel_id, query, year in dashboard_cache.most_requested(DASHBOARD_CACHE_WARMUP)]
+    if keys:
+        await update_one(MONGODB_COLLECTION_SYNC, {"_id": CACHE_STATE_ID}, {"$set": {"keys": keys}}, upsert=True)
+
 @router.get("/")
 def read_root():
     return {"Hello": "Data Provider"}
 
 @router.get("/dashboard", response_model=DashboardResponse, tags=["dashboard"])
 async def get_dashboard(
+    request: Request,
     hotel_id: int = Query(..., description="The ID of the hotel"),
     period: str = Query(..., description="The period of the dashboard (day, month, or day+month)"),
-    year: int = Query(..., description="The year of the dashboard")
+    year: int = Query(..., description="The year of the dashboard"),
+    include_detail: bool = Query(True, description="Include the bookings behind every total"),
+    detail_for: Optional[str] = Query(None, description="Only return the bookings of one day (YYYY-MM-DD) or month (YYYY-MM)"),
+    limit: int = Query(100, ge=1, le=10000, description="Maximum number of bookings returned for detail_for"),
+    offset: int = Query(0, ge=0, description="Number of bookings of detail_for to skip"),
+    from_: Optional[date] = Query(None, alias="from", description="Only return days and months on or after this date"),
+    to: Optional[date] = Query(None, description="Only return days and months on or before this date")
 ):
     valid_periods = ["day", "month", "day+month"]
     normalized_period = period.replace(" ", "+")
     
     if normalized_period not in valid_periods:
         raise HTTPException(status_code=400, detail=f"Invalid period. Must be one of: {', '.join(valid_periods)}")
+
+    if detail_for:
+        try:
+            date.fromisoformat(detail_for if len(detail_for) == 10 else f"{detail_for}-01")
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid detail_for. Must be a day (YYYY-MM-DD) or a month (YYYY-MM)")
+        query = DashboardQuery(normalized_period, detail_for=detail_for, limit=limit, offset=offset)
+    else:
+        # limit and offset only page the bookings of detail_for, so they are
+        # left out of the cache key of every other request.
+        query = DashboardQuery(
+            normalized_period,
+            include_detail=include_detail,
+            start=from_.isoformat() if from_ else None,
+            end=to.isoformat() if to else None
+        )
     
     try:
-        dashboard_data = await get_dashboard_data(hotel_id, normalized_period, year)
-        return dashboard_data
+        return await render_dashboard(hotel_id, query, year, request)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/dashboard/batch", tags=["dashboard"])
+async def get_dashboard_batch(
+    hotel_ids: List[str] = Query(..., description="IDs of the hotels, repeated (hotel_ids=1&hotel_ids=2) or comma separated"),
+    period: str = Query(..., description="The period of the dashboard (day, month, or day+month)"),
+    year_from: int = Query(..., description="First year of the dashboards"),
+    year_to: Optional[int] = Query(None, description="Last year of the dashboards, year_from if omitted"),
+    include_detail: bool = Query(False, description="Include the bookings behind every total"),
+    from_: Optional[date] = Query(None, alias="from", description="Only return days and months on or after this date"),
+    to: Optional[date] = Query(None, description="Only return days and months on or before this date")
+):
+    valid_periods = ["day", "month", "day+month"]
+    normalized_period = period.replace(" ", "+")
+
+    if normalized_period not in valid_periods:
+        raise HTTPException(status_code=400, detail=f"Invalid period. Must be one of: {', '.join(valid_periods)}")
+
+    try:
+        hotel_ids = [int(hotel_id) for value in hotel_ids for hotel_id in value.split(",") if hotel_id.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid hotel_ids. Must be integers")
+
+    year_to = year_to if year_to is not None else year_from
+    if year_to < year_from or year_to - year_from >= DASHBOARD_BATCH_MAX_YEARS:
+        raise HTTPException(status_code=400, detail=f"year_to must be between year_from and year_from + {DASHBOARD_BATCH_MAX_YEARS - 1}")
+    if len(hotel_ids) > DASHBOARD_BATCH_MAX_HOTELS:
+        raise HTTPException(status_code=400, detail=f"At most {DASHBOARD_BATCH_MAX_HOTELS} hotel_ids per request")
+
+    return StreamingResponse(
+        stream_dashboards(hotel_ids, normalized_period, year_from, year_to, include_detail, from_, to),
+        media_type="application/x-ndjson"
+    )
+
+async def stream_dashboards(hotel_ids, period, year_from, year_to, include_detail, start, end):
+    # One line per hotel, so a portfolio view can render hotels as they arrive.
+    async for hotel_id, years in iterate_dashboards(hotel_ids, year_from, year_to, period, include_detail, start, end):
+        yield orjson.dumps({"hotel_id": hotel_id, "period": PERIOD_NAMES[period], "years": years}) + b"\n"
+
+@router.post("/dashboard/rebuild", status_code=202, tags=["dashboard"])
+async def rebuild_dashboard():
+    # The grabber picks the flag up on its next cycle and refetches the full history.
+    try:
+        await update_one(
+            MONGODB_COLLECTION_SYNC,
+            {"_id": SYNC_STATE_ID},
+            {"$set": {"rebuild_requested": True}},
+            upsert=True
+        )
+        return {"status": "rebuild scheduled"}
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,101 @@
+"""Offline benchmarks of the dashboard rebuild and read paths.
+
+MongoDB is replaced by mongomock_motor, so the numbers measure this
+service's own code: building the daily documents and views, change
+detection, projections and response assembly. They are compared with the
+JSON baseline in benchmarks/baselines. They are smoke numbers for catching
+regressions, not comparable with a deployment against a real server.
+"""
+import argparse
+import asyncio
+import gc
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# benchmark_baseline.py lives at the repository root and is shared with the other service.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from mongomock_motor import AsyncMongoMockClient
+from benchmark_baseline import report, save_baseline
+from database import mongodb
+from database.mongodb import get_dashboard_data
+from event.dashboard_grabber import MONGODB_COLLECTION, MONGODB_COLLECTION_VIEW, update_database
+from mongo_indexes import DASHBOARD_INDEXES, DASHBOARD_VIEW_INDEXES
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "dashboard.json")
+YEAR = 2024
+
+def night_stats(hotel_id, bookings):
+    """Rows of /events/stats?group_by=night for a hotel with `bookings` bookings in YEAR."""
+    rows = {}
+    start = date(YEAR, 1, 1)
+    for i in range(bookings):
+        night = (start + timedelta(days=random.randint(0, 365))).isoformat()
+        row = rows.setdefault(night, {"hotel_id": hotel_id, "key": night, "count": 0, "ids": [], "room_ids": []})
+        row["count"] += 1
+        row["ids"].append(hotel_id * 10_000_000 + i)
+        row["room_ids"].append(str(100 + i % 300))
+    return list(rows.values())
+
+async def bench_rebuild(stats):
+    started = time.perf_counter()
+    await update_database(stats, YEAR)
+    return time.perf_counter() - started
+
+async def bench_dashboard(hotel_id, repeat, **options):
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        await get_dashboard_data(hotel_id, "day+month", YEAR, **options)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+async def run(args):
+    random.seed(1)
+    mongodb.db.client = AsyncMongoMockClient()
+    mongodb.db.db = mongodb.db.client["benchmark"]
+    await mongodb.ensure_indexes(mongodb.db.db[MONGODB_COLLECTION], DASHBOARD_INDEXES)
+    await mongodb.ensure_indexes(mongodb.db.db[MONGODB_COLLECTION_VIEW], DASHBOARD_VIEW_INDEXES)
+
+    results = {}
+    stats = []
+    for hotel_id, bookings in enumerate(args.hotel_sizes, start=1):
+        stats.extend(night_stats(hotel_id, bookings))
+    results["rebuild_year_s"] = await bench_rebuild(stats)
+    # The same history again: change detection should skip every document.
+    results["rebuild_unchanged_year_s"] = await bench_rebuild(stats)
+
+    for hotel_id, bookings in enumerate(args.hotel_sizes, start=1):
+        results[f"dashboard_{bookings}_bookings_ms"] = await bench_dashboard(hotel_id, args.repeat)
+        results[f"dashboard_{bookings}_bookings_totals_ms"] = await bench_dashboard(hotel_id, args.repeat, include_detail=False)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark update_database and get_dashboard_data without MongoDB.")
+    parser.add_argument("--hotel-sizes", type=int, nargs="+", default=[100, 1000, 10000, 50000], help="Bookings of each benchmarked hotel in one year")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per dashboard read, the median is reported")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative slowdown against the baseline that counts as a regression")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--check", action="store_true", help="Exit with an error if a metric regressed")
+    args = parser.parse_args()
+
+    # Per-write logging would dominate the timings.
+    logging.disable(logging.INFO)
+    results = asyncio.run(run(args))
+
+    options = {name: value for name, value in vars(args).items() if name not in ("tolerance", "save_baseline", "check")}
+    regressions = report(BASELINE_PATH, results, args.tolerance, options)
+    if args.save_baseline:
+        save_baseline(BASELINE_PATH, results, options)
+    if regressions and args.check:
+        raise SystemExit(f"Regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orjson
+from model.dashboard_model import BookingData, DashboardResponse, EventDetail
+
+def materialized_view(rows):
+    """A dashboard_view document holding `rows` bookings spread over one year."""
+    daily = {}
+    monthly = {}
+    start = date(2024, 1, 1)
+    for i in range(rows):
+        night = (start + timedelta(days=i % 366)).isoformat()
+        detail = {"id": str(i), "room_id": str(i % 300), "night_of_stay": night}
+        for bucket, key in ((daily, night), (monthly, night[:7])):
+            booking = bucket.setdefault(key, {"total": 0, "detail": []})
+            booking["total"] += 1
+            booking["detail"].append(detail)
+    return {"hotel_id": 1, "period": "daily+monthly", "year": 2024, "detail": {"daily": daily, "monthly": monthly}}
+
+def model_path(view):
+    # What GET /dashboard did before: an EventDetail per booking and a
+    # DashboardResponse that FastAPI validates and encodes again.
+    detail = {
+        period: {
+            key: BookingData(total=booking["total"], detail=[EventDetail(**event) for event in booking["detail"]])
+            for key, booking in bookings.items()
+        }
+        for period, bookings in view["detail"].items()
+    }
+    response = DashboardResponse(hotel_id=view["hotel_id"], period=view["period"], year=view["year"], detail=detail)
+    content = DashboardResponse.model_validate(response).model_dump(mode="json")
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+def fast_path(view):
+    return orjson.dumps(view)
+
+def measure(function, view, repeat):
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        body = function(view)
+        timings.append(time.perf_counter() - started)
+    return min(timings), len(body)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the GET /dashboard serialization paths.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000], help="Bookings in the hotel-year")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per size, the fastest one is reported")
+    args = parser.parse_args()
+
+    check = materialized_view(100)
+    if json.loads(model_path(check)) != json.loads(fast_path(check)):
+        raise SystemExit("The fast path does not produce the same response as the model path")
+
+    print(f"{'rows':>9} {'model s':>9} {'fast s':>9} {'speedup':>8} {'MB':>8}")
+    for rows in args.rows:
+        view = materialized_view(rows)
+        model_seconds, size = measure(model_path, view, args.repeat)
+        fast_seconds, _ = measure(fast_path, view, args.repeat)
+        print(f"{rows:>9} {model_seconds:>9.3f} {fast_seconds:>9.3f} {model_seconds / fast_seconds:>7.1f}x {size / 1e6:>8.1f}")
+        del view
+
+if __name__ == "__main__":
+    main()
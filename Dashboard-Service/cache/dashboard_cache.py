@@ -0,0 +1,72 @@
+from collections import Counter, OrderedDict
+from dotenv import load_dotenv
+import os
+from monitoring.metrics import CACHE_ENTRIES, CACHE_REQUESTS
+
+load_dotenv(override=True)
+
+DASHBOARD_CACHE_SIZE = int(os.getenv("DASHBOARD_CACHE_SIZE", 1024))
+DASHBOARD_CACHE_WARMUP = int(os.getenv("DASHBOARD_CACHE_WARMUP", 50))
+
+class DashboardCache:
+    """Bounded LRU of serialized GET /dashboard responses keyed by (hotel_id, query, year).
+
+    Every (hotel_id, year) has a generation that the grabber bumps after it
+    writes new aggregates. A response is stored together with the generation
+    it was read under and is only served while that generation is current, so
+    a read that raced with a write can never put stale bytes back.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.epoch = 0
+        self.year_generations = {}
+        self.hotel_generations = {}
+        self.requests = Counter()
+
+    def generation(self, hotel_id, year):
+        return self.epoch, self.year_generations.get(year, 0), self.hotel_generations.get((hotel_id, year), 0)
+
+    def get(self, key):
+        hotel_id, _, year = key
+        self.requests[key] += 1
+        if len(self.requests) > 10 * max(self.max_entries, 1):
+            self.requests = Counter(dict(self.requests.most_common(self.max_entries)))
+
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != self.generation(hotel_id, year):
+            CACHE_REQUESTS.labels("miss").inc()
+            return None
+        self.entries.move_to_end(key)
+        CACHE_REQUESTS.labels("hit").inc()
+        return entry[1]
+
+    def put(self, key, generation, entry):
+        hotel_id, _, year = key
+        if self.max_entries <= 0 or generation != self.generation(hotel_id, year):
+            return
+        self.entries[key] = (generation, entry)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, hotel_id, year):
+        self.hotel_generations[(hotel_id, year)] = self.hotel_generations.get((hotel_id, year), 0) + 1
+        for key in [key for key in self.entries if key[0] == hotel_id and key[2] == year]:
+            del self.entries[key]
+
+    def invalidate_year(self, year):
+        self.year_generations[year] = self.year_generations.get(year, 0) + 1
+        for key in [key for key in self.entries if key[2] == year]:
+            del self.entries[key]
+
+    def invalidate_all(self):
+        self.epoch += 1
+        self.entries.clear()
+
+    def most_requested(self, count):
+        return [key for key, _ in self.requests.most_common(count)]
+
+dashboard_cache = DashboardCache(DASHBOARD_CACHE_SIZE)
+CACHE_ENTRIES.set_function(lambda: len(dashboard_cache.entries))
@@ -5,44 +5,54 @@ print(f"Python executable: {sys.executable}")
 from fastapi import FastAPI
 from contextlib import asynccontextmanager
 import os
-from api.dash import router as dash_router
-from database.mongodb import connect_to_mongo, close_mongo_connection, db
+from api.dash import router as dash_router, warm_up_dashboard_cache, save_dashboard_cache_keys
+from api.metrics import router as metrics_router
+from monitoring.metrics import track_request
+from database.mongodb import connect_to_mongo, close_mongo_connection, db, ensure_indexes
 from dotenv import load_dotenv
-from pymongo import ASCENDING
+from mongo_indexes import DASHBOARD_INDEXES, DASHBOARD_VIEW_INDEXES, RETIRED_DASHBOARD_INDEXES
+from cache.dashboard_cache import DASHBOARD_CACHE_WARMUP
 import asyncio
-from event.dashboard_grabber import dashboard_grabber
+from event.dashboard_grabber import dashboard_grabber, close_provider_client, VIEW_VERSION, MONGODB_COLLECTION_VIEW, MONGODB_COLLECTION_SYNC, SYNC_STATE_ID, CURSOR_ORDER
+from event.dashboard_subscriber import start_dashboard_subscriber
 
 load_dotenv(override=True)
 
+DASHBOARD_SUBSCRIBE = os.getenv("DASHBOARD_SUBSCRIBE", "true").lower() == "true"
+
 async def setup_mongodb():
     mongodb_db = os.getenv("MONGODB_DB")
     mongodb_collection = os.getenv("MONGODB_COLLECTION_DASHBOARD")
     
-    if mongodb_db not in db.client.list_database_names():
+    if mongodb_db not in await db.client.list_database_names():
         print(f"Creating database: {mongodb_db}")
     
-    if mongodb_collection not in db.db.list_collection_names():
+    if mongodb_collection not in await db.db.list_collection_names():
         print(f"Creating collection: {mongodb_collection}")
-        db.db.create_collection(mongodb_collection)
+        await db.db.create_collection(mongodb_collection)
     
     collection = db.db[mongodb_collection]
     
-    indexes_to_create = [
-        ("hotel_id", ASCENDING),
-        ("year", ASCENDING),
-        ("date", ASCENDING),
-        ("type", ASCENDING)
-    ]
-    
-    existing_indexes = collection.index_information()
-    
-    for field, direction in indexes_to_create:
-        index_name = f"{field}_1"
-        if index_name not in existing_indexes:
-            print(f"Creating index for field: {field}")
-            collection.create_index([(field, direction)])
-        else:
-            print(f"Index already exists for field: {field}")
+    await ensure_indexes(collection, DASHBOARD_INDEXES, RETIRED_DASHBOARD_INDEXES)
+
+    view_collection = db.db[MONGODB_COLLECTION_VIEW]
+    await ensure_indexes(view_collection, DASHBOARD_VIEW_INDEXES)
+
+    # Dashboards built before the views existed only have daily documents, and
+    # views of an older layout cannot take incremental merges; a rebuild
+    # materializes them again from the Data Provider.
+    views_missing = await view_collection.estimated_document_count() == 0 and await collection.estimated_document_count() > 0
+    views_outdated = await view_collection.find_one({"version": {"$ne": VIEW_VERSION}}, {"_id": 1}) is not None
+    # Checkpoints taken on event timestamps miss events stored late with an old timestamp.
+    checkpoint = await db.db[MONGODB_COLLECTION_SYNC].find_one({"_id": SYNC_STATE_ID}, {"cursor_order": 1})
+    checkpoint_outdated = checkpoint is not None and checkpoint.get("cursor_order") != CURSOR_ORDER
+    if views_missing or views_outdated or checkpoint_outdated:
+        print("Dashboard views or the sync checkpoint are missing or outdated, scheduling a full rebuild")
+        await db.db[MONGODB_COLLECTION_SYNC].update_one(
+            {"_id": SYNC_STATE_ID},
+            {"$set": {"rebuild_requested": True}},
+            upsert=True
+        )
 
 async def start_dashboard_grabber():
     while True:
@@ -55,11 +65,27 @@ async def start_dashboard_grabber():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    connect_to_mongo()
+    await connect_to_mongo()
     await setup_mongodb()
+    if DASHBOARD_CACHE_WARMUP > 0:
+        await warm_up_dashboard_cache()
     asyncio.create_task(start_dashboard_grabber())
+    subscriber_task = None
+    if DASHBOARD_SUBSCRIBE:
+        # Bookings are pushed over RabbitMQ; the grabber's poll stays on as a catch-up path.
+        subscriber_task = asyncio.create_task(start_dashboard_subscriber())
     yield
     # Shutdown
+    if subscriber_task:
+        subscriber_task.cancel()
+        try:
+            await subscriber_task
+        except asyncio.CancelledError:
+            print("Dashboard subscriber cancelled")
+    if DASHBOARD_CACHE_WARMUP > 0:
+        # The most requested dashboards are warmed up again on the next start.
+        await save_dashboard_cache_keys()
+    await close_provider_client()
     close_mongo_connection()
 
 description = """
@@ -94,6 +120,8 @@ app = FastAPI(lifespan=lifespan, docs_url="/documentation", openapi_tags=tags_me
 )
 
 app.include_router(dash_router)
+app.include_router(metrics_router)
+app.middleware("http")(track_request)
 
 if __name__ == "__main__":
     import uvicorn
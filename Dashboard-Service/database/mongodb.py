@@ -1,23 +1,42 @@
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
 from dotenv import load_dotenv
 import os
+import sys
 import asyncio
+from datetime import date, timedelta
 from typing import List
-from model.dashboard_model import DashboardResponse, BookingData
-from bson import ObjectId
-from model.dashboard_model import EventDetail
+
+# mongo_indexes.py lives at the repository root and is shared with rpgprep.py.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from pymongo.errors import OperationFailure
+from mongo_indexes import plan_indexes, unique_index_conflict, without_unique
+from monitoring.metrics import MONGO_LATENCY
 
 load_dotenv(override=True)
 
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", 100))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", 0))
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS", 2000))
+MONGODB_OP_TIMEOUT_MS = int(os.getenv("MONGODB_OP_TIMEOUT_MS", 10000))
+
 class MongoDB:
-    client: MongoClient = None
+    client: AsyncIOMotorClient = None
     db = None
 
 db = MongoDB()
 
-def connect_to_mongo():
+async def connect_to_mongo():
     try:
-        db.client = MongoClient(os.getenv("MONGODB_URL"))
+        # Shared by the API handlers and the grabber, so both draw from one pool.
+        db.client = AsyncIOMotorClient(
+            os.getenv("MONGODB_URL"),
+            maxPoolSize=MONGODB_MAX_POOL_SIZE,
+            minPoolSize=MONGODB_MIN_POOL_SIZE,
+            waitQueueTimeoutMS=MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+            serverSelectionTimeoutMS=5000
+        )
+        await db.client.admin.command('ping')
         db.db = db.client[os.getenv("MONGODB_DB")]
         print("Successfully connected to MongoDB")
     except Exception as e:
@@ -28,94 +47,192 @@ def close_mongo_connection():
     if db.client:
         db.client.close()
 
-async def run_mongo_task(func):
-    return await asyncio.to_thread(func)
+async def ensure_indexes(collection, spec, retired=()):
+    """Apply an index spec; returns the unique indexes stored duplicates forced to build without uniqueness."""
+    to_create, to_drop = plan_indexes(spec, await collection.index_information(), retired)
+    for name in to_drop:
+        print(f"Dropping index: {name}")
+        await collection.drop_index(name)
+    if not to_create:
+        print(f"Indexes of {collection.name} are up to date")
+        return []
+    print(f"Creating indexes: {', '.join(index.document['name'] for index in to_create)}")
+    try:
+        await collection.create_indexes(to_create)
+    except OperationFailure as e:
+        name = unique_index_conflict(spec, e)
+        if name is None:
+            raise
+        print(f"Stored documents of {collection.name} share keys of unique index {name}, building it without uniqueness")
+        return [name] + await ensure_indexes(collection, without_unique(spec, name), retired)
+    return []
+
+async def with_timeout(awaitable, timeout_ms=None, operation="other"):
+    with MONGO_LATENCY.labels(operation).time():
+        return await asyncio.wait_for(awaitable, timeout=(timeout_ms or MONGODB_OP_TIMEOUT_MS) / 1000)
 
 async def insert_one(collection, document):
-    return await run_mongo_task(lambda: db.db[collection].insert_one(document))
-
-async def find_one(collection, query):
-    return await run_mongo_task(lambda: db.db[collection].find_one(query))
+    return await with_timeout(db.db[collection].insert_one(document), operation="insert_one")
+
+async def update_one(collection, query, update, upsert=False):
+    return await with_timeout(db.db[collection].update_one(query, update, upsert=upsert), operation="update_one")
+
+async def find_one(collection, query, projection=None):
+    return await with_timeout(db.db[collection].find_one(query, projection, max_time_ms=MONGODB_OP_TIMEOUT_MS), operation="find_one")
+
+async def find(collection, query, projection=None):
+    return await with_timeout(db.db[collection].find(query, projection, max_time_ms=MONGODB_OP_TIMEOUT_MS).to_list(length=None), operation="find")
+
+async def bulk_write(collection, operations, ordered=False):
+    return await with_timeout(db.db[collection].bulk_write(operations, ordered=ordered), operation="bulk_write")
+
+async def delete_many(collection, query):
+    return await with_timeout(db.db[collection].delete_many(query), operation="delete_many")
+
+async def drop_collection(collection):
+    return await with_timeout(db.db.drop_collection(collection), operation="drop_collection")
+
+async def rename_collection(collection, target):
+    # dropTarget replaces `target` and its indexes in one step.
+    return await with_timeout(db.db[collection].rename(target, dropTarget=True), operation="rename")
+
+async def aggregate(collection, pipeline):
+    return await with_timeout(db.db[collection].aggregate(pipeline, maxTimeMS=MONGODB_OP_TIMEOUT_MS).to_list(length=None), operation="aggregate")
+
+# Fields of a materialized dashboard document needed by each period.
+PERIOD_FIELDS = {
+    "day": ["daily"],
+    "month": ["monthly"],
+    "day+month": ["daily", "monthly"],
+}
+
+PERIOD_NAMES = {
+    "day": "daily",
+    "month": "monthly",
+    "day+month": "daily+monthly",
+}
+
+def bucket_keys(name, start, end):
+    """Every day or month key between two dates, for projecting a bounded range."""
+    if name == "daily":
+        return [(start + timedelta(days=offset)).isoformat() for offset in range((end - start).days + 1)]
+    months = range(start.year * 12 + start.month - 1, end.year * 12 + end.month)
+    return [f"{month // 12:04d}-{month % 12 + 1:02d}" for month in months]
+
+def bucket_bounds(name, start, end):
+    # Day keys compare as YYYY-MM-DD and month keys as YYYY-MM.
+    size = 10 if name == "daily" else 7
+    return (start.isoformat()[:size] if start else None, end.isoformat()[:size] if end else None)
+
+async def get_dashboard_data(hotel_id: int, period: str, year: int, include_detail: bool = True,
+                             detail_for: str = None, start: date = None, end: date = None,
+                             limit: int = 100, offset: int = 0) -> dict:
+    collection = os.getenv("MONGODB_COLLECTION_DASHBOARD_VIEW", "dashboard_view")
+    query = {"hotel_id": hotel_id, "year": year}
+
+    # The grabber keeps one document per hotel and year: totals per day and
+    # month in `daily`/`monthly`, and the bookings behind them in
+    # `daily_detail`/`monthly_detail`. Every read is a single indexed lookup
+    # whose projection only returns what the response needs.
+    if detail_for:
+        name = "daily" if len(detail_for) == 10 else "monthly"
+        projection = {
+            "_id": 0,
+            f"{name}.{detail_for}": 1,
+            f"{name}_detail.{detail_for}": {"$slice": [offset, limit]}
+        }
+        view = await find_one(collection, query, projection) or {}
+        bookings = {}
+        if detail_for in view.get(name, {}):
+            bookings[detail_for] = {
+                "total": view[name][detail_for],
+                "detail": view.get(f"{name}_detail", {}).get(detail_for, [])
+            }
+        return {"hotel_id": hotel_id, "period": name, "year": year, "detail": {name: bookings}}
 
-async def find(collection, query):
-    return await run_mongo_task(lambda: list(db.db[collection].find(query)))
+    view = await find_one(collection, query, view_projection(period, include_detail, start, end)) or {}
 
-async def get_dashboard_data(hotel_id: int, period: str, year: int) -> DashboardResponse:
-    collection = os.getenv("MONGODB_COLLECTION_DASHBOARD")
-    
-    query = {
+    # Already in the DashboardResponse shape: the documents are written by the
+    # grabber, so no BookingData or EventDetail is built per booking.
+    return {
         "hotel_id": hotel_id,
+        "period": PERIOD_NAMES[period],
         "year": year,
-        "type": "daily"
+        "detail": view_detail(view, period, include_detail, start, end)
     }
 
-    daily_pipeline = [
-        {"$match": query},
-        {"$unwind": "$details"},
-        {"$group": {
-            "_id": "$date",
-            "total": {"$sum": "$count"},
-            "detail": {"$push": {
-                "id": {"$toString": "$details._id"},
-                "room_id": "$details.room_id",
-                "night_of_stay": "$date"
-            }}
-        }},
-        {"$sort": {"_id": 1}}
-    ]
-
-    monthly_pipeline = [
-        {"$match": query},
-        {"$unwind": "$details"},
-        {"$group": {
-            "_id": {"$substr": ["$date", 0, 7]},  # Group by YYYY-MM
-            "total": {"$sum": "$count"},
-            "detail": {"$push": {
-                "id": {"$toString": "$details._id"},
-                "room_id": "$details.room_id",
-                "night_of_stay": "$date"
-            }}
-        }},
-        {"$sort": {"_id": 1}}
-    ]
-
-    daily_result = await run_mongo_task(lambda: list(db.db[collection].aggregate(daily_pipeline)))
-    monthly_result = await run_mongo_task(lambda: list(db.db[collection].aggregate(monthly_pipeline)))
-
-    daily_bookings = {
-        item["_id"]: BookingData(total=item["total"], detail=[EventDetail(**detail) for detail in item["detail"]])
-        for item in daily_result
-    }
-
-    monthly_bookings = {
-        item["_id"]: BookingData(
-            total=item["total"], 
-            detail=[EventDetail(**detail) for detail in item["detail"]]
-        ) 
-        for item in monthly_result
-    }
-
-    if period == "day":
-        return DashboardResponse(
-            hotel_id=hotel_id,
-            period="daily",
-            year=year,
-            detail={"daily": daily_bookings}
-        )
-    elif period == "month":
-        return DashboardResponse(
-            hotel_id=hotel_id,
-            period="monthly",
-            year=year,
-            detail={"monthly": monthly_bookings}
-        )
-    else:  # period == "day+month"
-        return DashboardResponse(
-            hotel_id=hotel_id,
-            period="daily+monthly",
-            year=year,
-            detail={
-                "daily": daily_bookings,
-                "monthly": monthly_bookings
-            }
-        )
\ No newline at end of file
+async def get_dashboard_version(hotel_id: int, year: int):
+    """(updated_at, generation) of a hotel-year view; every grabber write moves at least one of them."""
+    collection = os.getenv("MONGODB_COLLECTION_DASHBOARD_VIEW", "dashboard_view")
+    view = await find_one(collection, {"hotel_id": hotel_id, "year": year}, {"_id": 0, "updated_at": 1, "generation": 1}) or {}
+    return view.get("updated_at"), view.get("generation", 0)
+
+def view_projection(period, include_detail, start=None, end=None):
+    projection = {"_id": 0}
+    for name in PERIOD_FIELDS[period]:
+        if start and end and (end - start).days <= 366:
+            keys = bucket_keys(name, start, end)
+        else:
+            keys = None
+        for path in ([name, f"{name}_detail"] if include_detail else [name]):
+            if keys is None:
+                projection[path] = 1
+            else:
+                projection.update({f"{path}.{key}": 1 for key in keys})
+    return projection
+
+def view_detail(view, period, include_detail, start=None, end=None):
+    detail = {}
+    for name in PERIOD_FIELDS[period]:
+        low, high = bucket_bounds(name, start, end)
+        # Incremental merges append new days and months at the end of the maps.
+        keys = [
+            key for key in sorted(view.get(name, {}))
+            if (low is None or key >= low) and (high is None or key <= high)
+        ]
+        if include_detail:
+            details = view.get(f"{name}_detail", {})
+            detail[name] = {key: {"total": view[name][key], "detail": details.get(key, [])} for key in keys}
+        else:
+            detail[name] = {key: {"total": view[name][key]} for key in keys}
+    return detail
+
+async def iterate_dashboards(hotel_ids, year_from, year_to, period, include_detail, start=None, end=None):
+    """Yield (hotel_id, {year: detail}) for every requested hotel, in hotel_id order.
+
+    All hotels and years are read with one `$in` query that walks the
+    hotel_id_year index, and each hotel is yielded as soon as its last year
+    has arrived. Hotels without any dashboard get an empty mapping.
+    """
+    collection = os.getenv("MONGODB_COLLECTION_DASHBOARD_VIEW", "dashboard_view")
+    hotel_ids = sorted(set(hotel_ids))
+    projection = view_projection(period, include_detail, start, end)
+    projection.update({"hotel_id": 1, "year": 1})
+    cursor = db.db[collection].find(
+        {"hotel_id": {"$in": hotel_ids}, "year": {"$gte": year_from, "$lte": year_to}},
+        projection,
+        sort=[("hotel_id", 1), ("year", 1)],
+        max_time_ms=MONGODB_OP_TIMEOUT_MS
+    )
+
+    pending = iter(hotel_ids)
+    current, years = None, {}
+    try:
+        async for view in cursor:
+            if view["hotel_id"] != current:
+                if current is not None:
+                    yield current, years
+                # Hotels between the previous and this one have no dashboard.
+                for hotel_id in pending:
+                    if hotel_id == view["hotel_id"]:
+                        break
+                    yield hotel_id, {}
+                current, years = view["hotel_id"], {}
+            years[str(view["year"])] = view_detail(view, period, include_detail, start, end)
+    finally:
+        await cursor.close()
+
+    if current is not None:
+        yield current, years
+    for hotel_id in pending:
+        yield hotel_id, {}
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import os
+import logging
+import traceback
+from datetime import datetime
+from urllib.parse import quote_plus
+from aio_pika import connect_robust, ExchangeType
+from dotenv import load_dotenv
+from pymongo.errors import ConnectionFailure
+from event.dashboard_grabber import merge_events
+
+load_dotenv(override=True)
+
+RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "172.30.0.3")
+RABBITMQ_USER = os.getenv("RABBITMQ_USER", "guest")
+RABBITMQ_PASS = os.getenv("RABBITMQ_PASS", "guest")
+RABBITMQ_PORT = os.getenv("RABBITMQ_PORT", "5672")
+RABBITMQ_EVENTS_EXCHANGE = os.getenv("RABBITMQ_EVENTS_EXCHANGE", "blankon_events")
+RABBITMQ_DASHBOARD_QUEUE = os.getenv("RABBITMQ_DASHBOARD_QUEUE", "dashboard_events")
+SUBSCRIBER_PREFETCH = int(os.getenv("DASHBOARD_SUBSCRIBER_PREFETCH", 500))
+SUBSCRIBER_BATCH_SIZE = int(os.getenv("DASHBOARD_SUBSCRIBER_BATCH_SIZE", 200))
+SUBSCRIBER_BATCH_LINGER = int(os.getenv("DASHBOARD_SUBSCRIBER_BATCH_LINGER_MS", 50)) / 1000
+
+# The dashboard aggregates bookings only (rpg_status 1), like the /events poll does.
+BOOKED_ROUTING_KEY = "event.booked.#"
+
+logger = logging.getLogger(__name__)
+
+# Errors a redelivery can get past: MongoDB unreachable or too slow to answer.
+TRANSIENT_ERRORS = (ConnectionFailure, asyncio.TimeoutError)
+
+def parse_event(body):
+    """Decode a stored-event message, checking the fields merge_events reads.
+
+    Raises ValueError for a message that can never be merged.
+    """
+    try:
+        event = json.loads(body)
+        datetime.fromisoformat(event["night_of_stay"].replace("Z", "+00:00"))
+        datetime.fromisoformat(event["timestamp"].replace("Z", "+00:00"))
+        if event["id"] is None or not isinstance(event["hotel_id"], int) or event["room_id"] is None:
+            raise ValueError("id, hotel_id and room_id are required")
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f"missing or invalid field {str(e)}") from e
+    return event
+
+async def process_batch(batch):
+    """Merge a batch of messages, settling each of them.
+
+    Malformed messages are rejected without requeue, as redelivering them
+    cannot help. A transient MongoDB error requeues the batch and is raised,
+    so the subscriber reconnects; any other error rejects the batch, and the
+    checkpoint poll picks its events up from the Data Provider.
+    """
+    valid = []
+    for message in batch:
+        try:
+            valid.append((message, parse_event(message.body)))
+        except ValueError as e:
+            logger.error(f"Rejecting malformed event message: {str(e)}")
+            await message.reject(requeue=False)
+    if not valid:
+        return
+
+    try:
+        await merge_events([event for _, event in valid])
+    except TRANSIENT_ERRORS:
+        for message, _ in valid:
+            await message.nack(requeue=True)
+        raise
+    except Exception as e:
+        logger.error(f"Rejecting {len(valid)} event messages that failed to merge: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        for message, _ in valid:
+            await message.reject(requeue=False)
+        return
+    # Rejected messages are settled already, so this acks exactly the merged ones.
+    await valid[-1][0].ack(multiple=True)
+
+async def subscribe():
+    url = f"amqp://{quote_plus(RABBITMQ_USER)}:{quote_plus(RABBITMQ_PASS)}@{RABBITMQ_HOST}:{RABBITMQ_PORT}/"
+    connection = await connect_robust(url)
+
+    try:
+        channel = await connection.channel()
+        await channel.set_qos(prefetch_count=SUBSCRIBER_PREFETCH)
+        exchange = await channel.declare_exchange(RABBITMQ_EVENTS_EXCHANGE, ExchangeType.TOPIC, durable=True)
+        queue = await channel.declare_queue(RABBITMQ_DASHBOARD_QUEUE, durable=True)
+        await queue.bind(exchange, routing_key=BOOKED_ROUTING_KEY)
+        logger.info(f"Subscribed {RABBITMQ_DASHBOARD_QUEUE} to {RABBITMQ_EVENTS_EXCHANGE} ({BOOKED_ROUTING_KEY})")
+
+        pending = asyncio.Queue()
+        await queue.consume(pending.put)
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await pending.get()]
+            deadline = loop.time() + SUBSCRIBER_BATCH_LINGER
+            while len(batch) < SUBSCRIBER_BATCH_SIZE:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(pending.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            await process_batch(batch)
+    finally:
+        await connection.close()
+
+async def start_dashboard_subscriber():
+    retry_delay = 5
+
+    while True:
+        try:
+            await subscribe()
+        except asyncio.CancelledError:
+            logger.info("Dashboard subscriber was cancelled")
+            raise
+        except Exception as e:
+            logger.error(f"Error in dashboard subscriber: {str(e)}")
+            logger.error(f"Traceback: {traceback.format_exc()}")
+            logger.info(f"Retrying in {retry_delay} seconds...")
+            await asyncio.sleep(retry_delay)
@@ -9,7 +9,8 @@ class EventDetail(BaseModel):
 
 class BookingData(BaseModel):
     total: int
-    detail: List[EventDetail]
+    # Left out when the dashboard is requested with include_detail=false.
+    detail: Optional[List[EventDetail]] = None
 
 class DashboardResponse(BaseModel):
     hotel_id: int
@@ -0,0 +1,74 @@
+from prometheus_client import Counter, Gauge, Histogram
+import time
+
+# Request latency per route template, so every hotel_id is one series.
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Latency of HTTP requests until the response starts",
+    ["method", "route", "status"]
+)
+
+MONGO_LATENCY = Histogram(
+    "mongodb_operation_duration_seconds",
+    "Latency of MongoDB operations",
+    ["operation"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+
+PROVIDER_FETCH_LATENCY = Histogram(
+    "dashboard_provider_fetch_duration_seconds",
+    "Latency of Data Provider requests made by the grabber",
+    ["path", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+
+REBUILD_DURATION = Histogram(
+    "dashboard_rebuild_hotel_year_duration_seconds",
+    "Time to fetch and write the dashboards of one hotel-year during a rebuild",
+    ["year"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+
+GRABBER_CYCLE_DURATION = Histogram(
+    "dashboard_grabber_cycle_duration_seconds",
+    "Duration of a grabber cycle",
+    ["kind"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800)
+)
+
+EVENTS_PROCESSED = Counter(
+    "dashboard_events_processed_total",
+    "Booking events folded into the dashboards",
+    ["source", "outcome"]
+)
+
+DOCUMENTS_WRITTEN = Counter(
+    "dashboard_documents_total",
+    "Daily documents handled by rebuilds",
+    ["outcome"]
+)
+
+CACHE_REQUESTS = Counter(
+    "dashboard_cache_requests",
+    "Dashboard cache lookups",
+    ["result"]
+)
+
+# Bound to the cache singleton in cache/dashboard_cache.py.
+CACHE_ENTRIES = Gauge("dashboard_cache_entries", "Responses held by the dashboard cache")
+
+async def track_request(request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # The router stores the matched route in the scope.
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(
+            request.method,
+            route.path if route is not None else "unmatched",
+            status
+        ).observe(time.perf_counter() - started)
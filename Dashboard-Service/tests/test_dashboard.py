@@ -0,0 +1,333 @@
+import pytest
+import sys
+import os
+import asyncio
+import orjson
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from httpx import AsyncClient, ASGITransport
+from datetime import date, datetime
+from mongomock_motor import AsyncMongoMockClient
+from dashboard import app
+from cache.dashboard_cache import DashboardCache
+from database import mongodb
+from database.mongodb import view_detail
+from event import dashboard_grabber, dashboard_subscriber
+from event.dashboard_grabber import MONGODB_COLLECTION, MONGODB_COLLECTION_VIEW, VIEW_VERSION, merge_events, merge_stats, month_windows, update_database
+from model.dashboard_model import DashboardResponse
+from mongo_indexes import DASHBOARD_INDEXES, DASHBOARD_VIEW_INDEXES
+
+# The dashboards are written and read through mongomock_motor, so these tests
+# run without a MongoDB server or a Data Provider.
+YEAR = 2024
+
+
+@pytest.fixture(scope="module")
+async def client():
+    async with AsyncClient(
+        transport=ASGITransport(app=app),
+        base_url="http://test"
+    ) as ac:
+        yield ac
+
+async def create_indexes():
+    await mongodb.ensure_indexes(mongodb.db.db[MONGODB_COLLECTION], DASHBOARD_INDEXES)
+    await mongodb.ensure_indexes(mongodb.db.db[MONGODB_COLLECTION_VIEW], DASHBOARD_VIEW_INDEXES)
+
+@pytest.fixture(autouse=True)
+def setup_teardown():
+    # A fresh database per test; mongomock_motor does not bind to an event loop.
+    mongodb.db.client = AsyncMongoMockClient()
+    mongodb.db.db = mongodb.db.client["test"]
+    asyncio.run(create_indexes())
+    yield
+    mongodb.close_mongo_connection()
+
+def night_row(hotel_id, night, ids):
+    """A row of /events/stats?group_by=night."""
+    return {"hotel_id": hotel_id, "key": night, "count": len(ids), "ids": ids, "room_ids": [str(100 + i) for i in ids]}
+
+def booking(event_id, hotel_id, night):
+    """An event as GET /events returns it."""
+    return {"id": event_id, "hotel_id": hotel_id, "timestamp": f"{YEAR}-01-01T10:00:00Z", "rpg_status": 1, "room_id": "101", "night_of_stay": night}
+
+async def seed_views(hotel_id):
+    await update_database([
+        night_row(hotel_id, f"{YEAR}-01-05", [1, 2]),
+        night_row(hotel_id, f"{YEAR}-02-10", [3]),
+        night_row(hotel_id, f"{YEAR}-03-15", [4, 5, 6])
+    ], YEAR)
+
+@pytest.mark.asyncio
+async def test_update_database_skips_unchanged_documents():
+    stats = [night_row(1, f"{YEAR}-01-05", [1, 2]), night_row(1, f"{YEAR}-01-06", [3])]
+    assert await update_database(stats, YEAR) == (2, 0)
+    assert await update_database(stats, YEAR) == (0, 2)
+
+    stats[0] = night_row(1, f"{YEAR}-01-05", [1, 2, 4])
+    assert await update_database(stats, YEAR) == (1, 1)
+
+    # A night without bookings anymore is deleted.
+    assert await update_database(stats[:1], YEAR) == (0, 1)
+    daily = await mongodb.db.db[MONGODB_COLLECTION].find({"year": YEAR}).to_list(None)
+    assert [(document["date"], document["count"]) for document in daily] == [(f"{YEAR}-01-05", 3)]
+
+@pytest.mark.asyncio
+async def test_sync_events_resumes_from_the_checkpoint(monkeypatch):
+    pages = {
+        None: ([booking(30, 10, f"{YEAR}-06-01"), booking(31, 10, f"{YEAR}-06-02")], "page-1"),
+        "page-1": ([], "page-1")
+    }
+    requested = []
+
+    async def fetch_events_after(cursor):
+        requested.append(cursor)
+        return pages[cursor]
+
+    monkeypatch.setattr(dashboard_grabber, "fetch_events_after", fetch_events_after)
+    monkeypatch.setattr(dashboard_grabber, "SYNC_PAGE_SIZE", 2)
+    await dashboard_grabber.sync_events({})
+    checkpoint = await dashboard_grabber.load_checkpoint()
+    assert checkpoint["after"] == "page-1"
+    assert checkpoint["last_timestamp"] == f"{YEAR}-01-01T10:00:00Z"
+
+    # The next cycle only asks for events stored after the checkpoint.
+    await dashboard_grabber.sync_events(checkpoint)
+    assert requested == [None, "page-1", "page-1"]
+    assert await mongodb.db.db[MONGODB_COLLECTION].count_documents({"hotel_id": 10}) == 2
+
+@pytest.mark.asyncio
+async def test_merge_events_applies_an_event_once():
+    events = [booking(10, 2, f"{YEAR}-04-01"), booking(11, 2, f"{YEAR}-04-01")]
+    assert await merge_events(events) == 2
+    # Redelivered by the subscriber and the checkpoint poll.
+    assert await merge_events(events + [booking(12, 2, f"{YEAR}-04-02")]) == 1
+
+    daily = await mongodb.db.db[MONGODB_COLLECTION].find_one({"hotel_id": 2, "date": f"{YEAR}-04-01"})
+    assert daily["count"] == 2
+    assert sorted(detail["_id"] for detail in daily["details"]) == ["10", "11"]
+    view = await mongodb.db.db[MONGODB_COLLECTION_VIEW].find_one({"hotel_id": 2, "year": YEAR})
+    assert view["daily"] == {f"{YEAR}-04-01": 2, f"{YEAR}-04-02": 1}
+    assert view["monthly"] == {f"{YEAR}-04": 3}
+    assert len(view["monthly_detail"][f"{YEAR}-04"]) == 3
+
+class Message:
+    """Stands in for an aio_pika message and records how it was settled."""
+    def __init__(self, body):
+        self.body = body
+        self.settled = None
+
+    async def ack(self, multiple=False):
+        self.settled = "ack"
+
+    async def reject(self, requeue=False):
+        self.settled = f"reject requeue={requeue}"
+
+    async def nack(self, requeue=True):
+        self.settled = f"nack requeue={requeue}"
+
+@pytest.mark.asyncio
+async def test_subscriber_rejects_malformed_messages_without_requeue():
+    good = Message(orjson.dumps(booking(20, 9, f"{YEAR}-05-01")))
+    malformed = [Message(b"not json"), Message(orjson.dumps({"id": 21, "hotel_id": 9})), Message(orjson.dumps(dict(booking(22, 9, f"{YEAR}-05-01"), id=None)))]
+    await dashboard_subscriber.process_batch([malformed[0], good] + malformed[1:])
+    assert good.settled == "ack"
+    assert [message.settled for message in malformed] == ["reject requeue=False"] * 3
+    daily = await mongodb.db.db[MONGODB_COLLECTION].find_one({"hotel_id": 9, "date": f"{YEAR}-05-01"})
+    assert daily["count"] == 1
+
+@pytest.mark.asyncio
+async def test_subscriber_requeues_on_transient_errors(monkeypatch):
+    async def merge_events(events):
+        raise asyncio.TimeoutError()
+
+    monkeypatch.setattr(dashboard_subscriber, "merge_events", merge_events)
+    message = Message(orjson.dumps(booking(23, 9, f"{YEAR}-05-02")))
+    with pytest.raises(asyncio.TimeoutError):
+        await dashboard_subscriber.process_batch([message])
+    assert message.settled == "nack requeue=True"
+
+def test_dashboard_cache_drops_responses_read_before_a_write():
+    cache = DashboardCache(2)
+    key = (1, "query", YEAR)
+    generation = cache.generation(1, YEAR)
+    # The grabber rewrote the view while the response was being read.
+    cache.invalidate(1, YEAR)
+    cache.put(key, generation, b"stale")
+    assert cache.get(key) is None
+
+    cache.put(key, cache.generation(1, YEAR), b"fresh")
+    assert cache.get(key) == b"fresh"
+    cache.invalidate_year(YEAR)
+    assert cache.get(key) is None
+
+@pytest.mark.asyncio
+async def test_get_dashboard_serves_rewritten_views(client):
+    async for c in client:
+        await seed_views(11)
+        params = {"hotel_id": 11, "period": "month", "year": YEAR, "include_detail": "false"}
+        response = await c.get("/dashboard", params=params)
+        assert response.json()["detail"]["monthly"][f"{YEAR}-01"] == {"total": 2}
+
+        await update_database([night_row(11, f"{YEAR}-01-05", [1, 2, 7])], YEAR)
+        response = await c.get("/dashboard", params=params)
+        assert response.json()["detail"]["monthly"] == {f"{YEAR}-01": {"total": 3}}
+        break
+
+@pytest.mark.asyncio
+async def test_get_dashboard_reads_the_hotel_year_view(client):
+    async for c in client:
+        detail = [{"id": "40", "room_id": "101", "night_of_stay": f"{YEAR}-07-01"}]
+        await mongodb.db.db[MONGODB_COLLECTION_VIEW].insert_one({
+            "hotel_id": 12, "year": YEAR, "version": VIEW_VERSION, "generation": 0, "updated_at": datetime(YEAR, 7, 1),
+            "daily": {f"{YEAR}-07-01": 1}, "monthly": {f"{YEAR}-07": 1},
+            "daily_detail": {f"{YEAR}-07-01": detail}, "monthly_detail": {f"{YEAR}-07": detail}
+        })
+
+        # There are no daily documents, so the response can only come from the view.
+        response = await c.get("/dashboard", params={"hotel_id": 12, "period": "day", "year": YEAR})
+        assert response.status_code == 200
+        assert response.json() == {
+            "hotel_id": 12, "period": "daily", "year": YEAR,
+            "detail": {"daily": {f"{YEAR}-07-01": {"total": 1, "detail": detail}}}
+        }
+        break
+
+@pytest.mark.asyncio
+async def test_get_dashboard_body_matches_the_response_model(client):
+    async for c in client:
+        await seed_views(13)
+        response = await c.get("/dashboard", params={"hotel_id": 13, "period": "day+month", "year": YEAR})
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/json"
+        # The body is written by orjson and skips response_model validation.
+        dashboard = DashboardResponse(**response.json())
+        assert dashboard.detail["daily"][f"{YEAR}-03-15"].total == 3
+        assert [detail.id for detail in dashboard.detail["monthly"][f"{YEAR}-03"].detail] == ["4", "5", "6"]
+        break
+
+def test_view_detail_filters_and_drops_details():
+    view = {
+        "daily": {f"{YEAR}-02-01": 1, f"{YEAR}-01-01": 2},
+        "daily_detail": {f"{YEAR}-02-01": [{"id": "1"}], f"{YEAR}-01-01": [{"id": "2"}, {"id": "3"}]}
+    }
+    assert view_detail(view, "day", include_detail=False) == {"daily": {f"{YEAR}-01-01": {"total": 2}, f"{YEAR}-02-01": {"total": 1}}}
+    assert view_detail(view, "day", include_detail=True, start=date(YEAR, 1, 15)) == {
+        "daily": {f"{YEAR}-02-01": {"total": 1, "detail": [{"id": "1"}]}}
+    }
+
+@pytest.mark.asyncio
+async def test_get_dashboard_include_detail(client):
+    async for c in client:
+        await seed_views(3)
+
+        response = await c.get("/dashboard", params={"hotel_id": 3, "period": "month", "year": YEAR})
+        assert response.status_code == 200
+        monthly = response.json()["detail"]["monthly"]
+        assert monthly[f"{YEAR}-03"]["total"] == 3
+        assert [detail["id"] for detail in monthly[f"{YEAR}-03"]["detail"]] == ["4", "5", "6"]
+
+        response = await c.get("/dashboard", params={"hotel_id": 3, "period": "month", "year": YEAR, "include_detail": "false"})
+        assert response.status_code == 200
+        assert response.json()["detail"]["monthly"] == {
+            f"{YEAR}-01": {"total": 2},
+            f"{YEAR}-02": {"total": 1},
+            f"{YEAR}-03": {"total": 3}
+        }
+        break
+
+@pytest.mark.asyncio
+async def test_get_dashboard_from_to(client):
+    async for c in client:
+        await seed_views(4)
+
+        response = await c.get("/dashboard", params={
+            "hotel_id": 4, "period": "day+month", "year": YEAR,
+            "from": f"{YEAR}-02-01", "to": f"{YEAR}-03-31", "include_detail": "false"
+        })
+        assert response.status_code == 200
+        detail = response.json()["detail"]
+        assert list(detail["daily"]) == [f"{YEAR}-02-10", f"{YEAR}-03-15"]
+        assert list(detail["monthly"]) == [f"{YEAR}-02", f"{YEAR}-03"]
+        break
+
+@pytest.mark.asyncio
+async def test_get_dashboard_batch(client):
+    async for c in client:
+        await seed_views(5)
+        await seed_views(7)
+
+        response = await c.get("/dashboard/batch", params={"hotel_ids": "7,5,6", "period": "month", "year_from": YEAR, "to": f"{YEAR}-01-31"})
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        lines = [orjson.loads(line) for line in response.content.splitlines()]
+        assert [line["hotel_id"] for line in lines] == [5, 6, 7]
+        assert lines[0]["years"] == {str(YEAR): {"monthly": {f"{YEAR}-01": {"total": 2}}}}
+        # Hotels without a dashboard still get their line.
+        assert lines[1]["years"] == {}
+
+        response = await c.get("/dashboard/batch", params={"hotel_ids": "5", "period": "week", "year_from": YEAR})
+        assert response.status_code == 400
+        break
+
+@pytest.mark.asyncio
+async def test_get_dashboard_not_modified(client):
+    async for c in client:
+        await seed_views(14)
+        params = {"hotel_id": 14, "period": "month", "year": YEAR}
+        response = await c.get("/dashboard", params=params)
+        etag = response.headers["ETag"]
+        assert "Last-Modified" in response.headers
+
+        response = await c.get("/dashboard", params=params, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+
+        # A merged booking moves the view's generation.
+        await merge_events([booking(50, 14, f"{YEAR}-01-05")])
+        response = await c.get("/dashboard", params=params, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        break
+
+def test_month_windows_cover_the_year_up_to_now():
+    assert month_windows(YEAR, datetime(YEAR, 3, 10, 12)) == [
+        (datetime(YEAR, 1, 1), datetime(YEAR, 1, 31, 23, 59, 59, 999999)),
+        (datetime(YEAR, 2, 1), datetime(YEAR, 2, 29, 23, 59, 59, 999999)),
+        (datetime(YEAR, 3, 1), datetime(YEAR, 3, 10, 12)),
+    ]
+    assert month_windows(YEAR, datetime(YEAR + 1, 6, 1))[-1] == (datetime(YEAR, 12, 1), datetime(YEAR, 12, 31, 23, 59, 59, 999999))
+
+def test_merge_stats_adds_up_nights_booked_in_different_months():
+    january = [night_row(1, f"{YEAR}-03-01", [1])]
+    february = [night_row(1, f"{YEAR}-03-01", [2]), night_row(1, f"{YEAR}-03-02", [3])]
+    assert merge_stats([january, february]) == [night_row(1, f"{YEAR}-03-01", [1, 2]), night_row(1, f"{YEAR}-03-02", [3])]
+
+@pytest.mark.asyncio
+async def test_swap_rebuild_keeps_older_years(monkeypatch):
+    await mongodb.db.db[MONGODB_COLLECTION_VIEW].insert_one({"hotel_id": 8, "year": 2000, "daily": {"2000-01-01": 1}, "monthly": {"2000-01": 1}})
+    await seed_views(8)
+    before = await mongodb.db.db[MONGODB_COLLECTION_VIEW].find_one({"hotel_id": 8, "year": YEAR})
+
+    async def fetch_event_stats(start, end, hotel_id=None, group_by="night", cursor_header="X-Next-Cursor"):
+        if group_by == "hotel":
+            return ([{"hotel_id": 8, "key": None, "count": 6}] if start.year == YEAR else []), "cursor"
+        # Every booking of the seeded views was made in January.
+        rows = [night_row(8, f"{YEAR}-01-05", [1, 2]), night_row(8, f"{YEAR}-02-10", [3]), night_row(8, f"{YEAR}-03-15", [4, 5, 6])]
+        return (rows if start.year == YEAR and start.month == 1 else []), None
+
+    async def get_years_to_process(collection):
+        return [YEAR - 1, YEAR]
+
+    monkeypatch.setattr(dashboard_grabber, "fetch_event_stats", fetch_event_stats)
+    monkeypatch.setattr(dashboard_grabber, "get_years_to_process", get_years_to_process)
+    monkeypatch.setattr(dashboard_grabber, "REBUILD_MODE", "swap")
+    await dashboard_grabber.full_rebuild()
+
+    assert await mongodb.db.db[MONGODB_COLLECTION_VIEW].count_documents({"hotel_id": 8, "year": 2000}) == 1
+    after = await mongodb.db.db[MONGODB_COLLECTION_VIEW].find_one({"hotel_id": 8, "year": YEAR})
+    assert after["monthly"] == before["monthly"]
+    # Unchanged views keep their validators across the swap.
+    assert after["updated_at"] == before["updated_at"]
+    checkpoint = await mongodb.db.db[dashboard_grabber.MONGODB_COLLECTION_SYNC].find_one({"_id": dashboard_grabber.SYNC_STATE_ID})
+    assert checkpoint["after"] == "cursor"
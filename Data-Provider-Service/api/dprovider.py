@@ -1,13 +1,36 @@
-from fastapi import APIRouter, HTTPException, Query
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from typing import List, Optional
 from datetime import datetime, date
-from model.data_provider_model import Event
-from database.mongodb import find
-from queuemq.broker import rabbitmq_broker
+from model.data_provider_model import Event, BatchResponse, BatchRowResult, EventStats
+from pydantic import ValidationError
+from database.mongodb import aggregate, estimated_count, events_state, find, iterate
+from database.event_schema import field, field_expression, legacy_schema, night_of_stay_as_date, to_row, to_utc
+from api.pagination import (
+    EVENT_SORT,
+    INGEST_SORT,
+    InvalidCursor,
+    apply_cursor,
+    apply_ingest_cursor,
+    encode_cursor,
+    encode_ingest_cursor,
+    ingest_horizon,
+)
+from api.conditional import make_etag, not_modified, validator_headers
+from queuemq.broker import broker
+import asyncio
 import json
+import logging
+import orjson
 import os
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
+
+EVENTS_BATCH_MAX_ROWS = int(os.getenv("EVENTS_BATCH_MAX_ROWS", 100000))
+EVENTS_BATCH_PUBLISH_SIZE = int(os.getenv("EVENTS_BATCH_PUBLISH_SIZE", 500))
+# Stored timestamps are naive UTC; rows write them as UTC with a "Z", as the Event model does.
+ROW_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
 
 @router.get("/")
 def read_root():
@@ -18,48 +41,259 @@ def read_root():
 def read_health():
     return {"status": "ok"}, 200
 
+def range_filter(gte, lte, convert):
+    bounds = {}
+    if gte:
+        bounds["$gte"] = convert(gte)
+    if lte:
+        bounds["$lte"] = convert(lte)
+    return bounds
+
+def build_event_query(hotel_id=None, updated__gte=None, updated__lte=None, rpg_status=None,
+                      room_id=None, night_of_stay__gte=None, night_of_stay__lte=None, legacy=False):
+    """Filter of GET /events and /events/stats.
+
+    With `legacy`, version 1 documents that migrate_events.py has not rewritten
+    yet match too. They keep the long field names and store both ranges as ISO
+    strings, which BSON never compares with dates or day ordinals.
+    """
+    def event_filter(name, timestamp, night):
+        query = {}
+
+        if hotel_id is not None:
+            query[name("hotel_id")] = hotel_id
+
+        if updated__gte or updated__lte:
+            query[name("timestamp")] = range_filter(updated__gte, updated__lte, timestamp)
+
+        if rpg_status is not None:
+            query[name("rpg_status")] = rpg_status
+
+        if room_id is not None:
+            query[name("room_id")] = room_id
+
+        if night_of_stay__gte or night_of_stay__lte:
+            query[name("night_of_stay")] = range_filter(night_of_stay__gte, night_of_stay__lte, night)
+
+        return query
+
+    query = event_filter(field, to_utc, date.toordinal)
+    if not legacy:
+        return query
+    # Version 1 wrote the isoformat() of the parsed timestamp, as the queries of that version compared.
+    v1 = event_filter(lambda name: name, lambda value: to_utc(value).isoformat(), date.isoformat)
+    return query if v1 == query else {"$or": [query, v1]}
+
+async def events_validators(request, collection, state, horizon=None):
+    """ETag and Last-Modified of an events query, from the ingest high-water mark.
+
+    Last-Modified is informational only: ObjectIds have second resolution, so
+    an event stored in the same second as a response would not move it, and
+    If-Modified-Since is not honoured. Revalidation goes through the ETag.
+
+    The API only ever adds events, so the newest _id and the document count
+    both move whenever a new event could change any result. Maintenance tools
+    that rewrite or delete stored events bump the events version instead.
+    Reading them is two _id lookups and a metadata read, however large the
+    query is. An ingest-order page also grows when stored events pass the
+    settle `horizon`.
+    """
+    latest, count = await asyncio.gather(
+        find(collection, {}, sort=[("_id", -1)], limit=1, projection={"_id": 1}),
+        estimated_count(collection)
+    )
+    version = state.get("version", 0)
+    if not latest:
+        return make_etag(request.url.query, None, count, version), state.get("updated_at")
+    object_id = latest[0]["_id"]
+    settling = str(horizon) if horizon is not None and object_id >= horizon else None
+    last_modified = max(filter(None, (object_id.generation_time.replace(tzinfo=None), state.get("updated_at"))))
+    return make_etag(request.url.query, str(object_id), count, version, settling), last_modified
+
+async def ingest_cursor(collection, horizon):
+    """Cursor of GET /events?order=ingest that resumes after every event stored so far."""
+    latest = await find(collection, {"_id": {"$lt": horizon}}, sort=[("_id", -1)], limit=1, projection={"_id": 1})
+    return encode_ingest_cursor(latest[0]) if latest else None
+
 @router.get("/events", response_model=List[Event], tags=["get_event"])
 async def get_events(
+    request: Request,
     hotel_id: Optional[int] = Query(None, description="Filter events by hotel ID"),
     updated__gte: Optional[datetime] = Query(None, description="Filter events updated on or after this datetime"),
     updated__lte: Optional[datetime] = Query(None, description="Filter events updated on or before this datetime"),
     rpg_status: Optional[int] = Query(None, description="Filter events by RPG status"),
     room_id: Optional[str] = Query(None, description="Filter events by room ID"),
     night_of_stay__gte: Optional[date] = Query(None, description="Filter events with night of stay on or after this date"),
-    night_of_stay__lte: Optional[date] = Query(None, description="Filter events with night of stay on or before this date")
+    night_of_stay__lte: Optional[date] = Query(None, description="Filter events with night of stay on or before this date"),
+    limit: Optional[int] = Query(None, ge=1, le=10000, description="Maximum number of events to return"),
+    after: Optional[str] = Query(None, description="Opaque cursor from the X-Next-Cursor header of the previous page"),
+    order: str = Query("timestamp", description="Page by event timestamp, or by ingest order (ingest) to poll for newly stored events"),
+    format: str = Query("json", description="Response format (json or ndjson)")
 ):
-    query = {}
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="Invalid format. Must be one of: json, ndjson")
+    if order not in ("timestamp", "ingest"):
+        raise HTTPException(status_code=400, detail="Invalid order. Must be one of: timestamp, ingest")
+
+    state = await events_state()
+    query = build_event_query(
+        hotel_id=hotel_id,
+        updated__gte=updated__gte,
+        updated__lte=updated__lte,
+        rpg_status=rpg_status,
+        room_id=room_id,
+        night_of_stay__gte=night_of_stay__gte,
+        night_of_stay__lte=night_of_stay__lte,
+        legacy=legacy_schema(state)
+    )
+
+    # Events can be stored long after their timestamp (backfills, replays),
+    # so pollers page by ingest order to see every new event once.
+    horizon = ingest_horizon() if order == "ingest" else None
+    sort, next_cursor = (INGEST_SORT, encode_ingest_cursor) if order == "ingest" else (EVENT_SORT, encode_cursor)
+    try:
+        if order == "ingest":
+            query = apply_ingest_cursor(query, after, horizon)
+        elif after:
+            query = apply_cursor(query, after)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    collection = os.getenv("MONGODB_COLLECTION")
+
+    etag, last_modified = await events_validators(request, collection, state, horizon)
+    headers = validator_headers(etag, last_modified)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    if format == "ndjson":
+        return StreamingResponse(
+            stream_events(collection, query, limit or 0, sort),
+            media_type="application/x-ndjson",
+            headers=headers
+        )
+
+    events = await find(collection, query, sort=sort, limit=limit or 0)
+    logger.debug(f"Found {len(events)} events for query {query}")
+
+    # A page shorter than `limit` is the last one, but the cursor is still
+    # returned so pollers can resume from it later.
+    if events:
+        headers["X-Next-Cursor"] = next_cursor(events[-1])
+
+    # Rows go straight from the stored documents to JSON bytes; response_model
+    # only documents the schema, since a returned Response is not validated again.
+    return Response(
+        content=orjson.dumps([to_row(event) for event in events], option=ROW_OPTIONS),
+        media_type="application/json",
+        headers=headers
+    )
 
-    if hotel_id is not None:
-        query["hotel_id"] = hotel_id
+async def stream_events(collection, query, limit, sort=EVENT_SORT):
+    async for event in iterate(collection, query, sort=sort, limit=limit):
+        yield orjson.dumps(to_row(event), option=ROW_OPTIONS) + b"\n"
 
-    if updated__gte or updated__lte:
-        query["timestamp"] = {}
-        if updated__gte:
-            query["timestamp"]["$gte"] = updated__gte.isoformat()
-        if updated__lte:
-            query["timestamp"]["$lte"] = updated__lte.isoformat()
+def stats_group_key(group_by, legacy=False):
+    if group_by == "night":
+        return field_expression("night_of_stay", legacy)
+    if group_by == "month":
+        stored = field_expression("night_of_stay", legacy)
+        # Version 1 documents not migrated yet hold an ISO date string, which
+        # sorts after every number in BSON order.
+        return {"$cond": [
+            {"$gte": [stored, ""]},
+            {"$substr": [stored, 0, 7]},
+            {"$dateToString": {"format": "%Y-%m", "date": night_of_stay_as_date()}}
+        ]}
+    return None
 
-    if rpg_status is not None:
-        query["rpg_status"] = rpg_status
+def merge_stats_groups(groups, group_by):
+    """Stats rows per hotel and key, with nights of both schema versions under one ISO date."""
+    rows = {}
+    for group in groups:
+        key = group["_id"]["key"]
+        if group_by == "night" and isinstance(key, int):
+            key = date.fromordinal(key).isoformat()
+        row = rows.setdefault((group["_id"]["hotel_id"], key), {"count": 0, "ids": [], "room_ids": []})
+        row["count"] += group["count"]
+        # Events stored with a null id before ids were assigned on null are
+        # counted, but have no id to list.
+        for event_id, room_id in zip(group.get("ids", []), group.get("room_ids", [])):
+            if event_id is not None:
+                row["ids"].append(event_id)
+                row["room_ids"].append(room_id)
+    return sorted(rows.items(), key=lambda item: (item[0][0], item[0][1] or ""))
 
-    if room_id is not None:
-        query["room_id"] = room_id
+@router.get("/events/stats", response_model=List[EventStats], tags=["get_event"])
+async def get_event_stats(
+    request: Request,
+    response: Response,
+    group_by: str = Query("night", description="Group events per hotel and night, month or hotel"),
+    include_ids: bool = Query(True, description="Include event ids and room ids of every group"),
+    hotel_id: Optional[int] = Query(None, description="Filter events by hotel ID"),
+    updated__gte: Optional[datetime] = Query(None, description="Filter events updated on or after this datetime"),
+    updated__lte: Optional[datetime] = Query(None, description="Filter events updated on or before this datetime"),
+    rpg_status: Optional[int] = Query(None, description="Filter events by RPG status"),
+    night_of_stay__gte: Optional[date] = Query(None, description="Filter events with night of stay on or after this date"),
+    night_of_stay__lte: Optional[date] = Query(None, description="Filter events with night of stay on or before this date")
+):
+    if group_by not in ("night", "month", "hotel"):
+        raise HTTPException(status_code=400, detail="Invalid group_by. Must be one of: night, month, hotel")
 
-    if night_of_stay__gte or night_of_stay__lte:
-        query["night_of_stay"] = {}
-        if night_of_stay__gte:
-            query["night_of_stay"]["$gte"] = night_of_stay__gte.isoformat()
-        if night_of_stay__lte:
-            query["night_of_stay"]["$lte"] = night_of_stay__lte.isoformat()
+    state = await events_state()
+    legacy = legacy_schema(state)
+    query = build_event_query(
+        hotel_id=hotel_id,
+        updated__gte=updated__gte,
+        updated__lte=updated__lte,
+        rpg_status=rpg_status,
+        night_of_stay__gte=night_of_stay__gte,
+        night_of_stay__lte=night_of_stay__lte,
+        legacy=legacy
+    )
+
+    group = {
+        "_id": {"hotel_id": field_expression("hotel_id", legacy), "key": stats_group_key(group_by, legacy)},
+        "count": {"$sum": 1}
+    }
+    if include_ids:
+        group["ids"] = {"$push": field_expression("id", legacy)}
+        group["room_ids"] = {"$push": field_expression("room_id", legacy)}
+
+    pipeline = [
+        {"$match": query},
+        {"$group": group},
+        {"$sort": {"_id.hotel_id": 1, "_id.key": 1}}
+    ]
 
     collection = os.getenv("MONGODB_COLLECTION")
-    events = await find(collection, query)
-    
-    print(f"Query: {query}")
-    print(f"Number of events found: {len(events)}")
 
-    return [Event(**event) for event in events]
+    etag, last_modified = await events_validators(request, collection, state)
+    headers = validator_headers(etag, last_modified)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+
+    # Read before the groups, so polling GET /events?order=ingest from here
+    # can only see an event twice, never miss one.
+    ingest_after = await ingest_cursor(collection, ingest_horizon())
+    if ingest_after:
+        response.headers["X-Ingest-Cursor"] = ingest_after
+
+    groups, last_events = await asyncio.gather(
+        aggregate(collection, pipeline),
+        find(collection, query, sort=[(field_name, -1) for field_name, _ in EVENT_SORT], limit=1)
+    )
+
+    # Same resume point as GET /events over this window, so pollers can switch
+    # from stats to incremental event fetches without a gap.
+    if last_events:
+        response.headers["X-Next-Cursor"] = encode_cursor(last_events[0])
+
+    stats = []
+    for (hotel_id, key), row in merge_stats_groups(groups, group_by):
+        stats.append(EventStats(hotel_id=hotel_id, key=key, **row))
+    return stats
 
 class DateTimeEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -75,9 +309,87 @@ async def create_event(event: Event):
         event_json = json.dumps(event_dict, cls=DateTimeEncoder)
         
         try:
-            await rabbitmq_broker.publish(event_json, str(event_dict["id"]))
+            await broker.publish(event_json, str(event_dict["id"]), event_dict["hotel_id"])
             return event
-        except Exception as rabbitmq_error:
-            raise HTTPException(status_code=500, detail=f"Failed to publish to RabbitMQ: {str(rabbitmq_error)}")
+        except Exception as broker_error:
+            raise HTTPException(status_code=500, detail=f"Failed to publish to the broker: {str(broker_error)}")
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to create event: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Failed to create event: {str(e)}")
+
+async def read_ndjson_rows(request: Request):
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+async def read_json_rows(request: Request):
+    try:
+        rows = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Request body must be a JSON array or NDJSON")
+    if not isinstance(rows, list):
+        raise HTTPException(status_code=400, detail="Request body must be a JSON array or NDJSON")
+    for row in rows:
+        yield row
+
+async def publish_rows(pending, results):
+    try:
+        outcomes = await broker.publish_batch(
+            [(event_json, str(event_id), hotel_id) for _, event_id, hotel_id, event_json in pending],
+            pipeline_size=EVENTS_BATCH_PUBLISH_SIZE
+        )
+    except Exception as broker_error:
+        outcomes = [broker_error] * len(pending)
+    for (index, event_id, _, _), error in zip(pending, outcomes):
+        if error is None:
+            results.append(BatchRowResult(index=index, status="accepted", id=event_id))
+        else:
+            results.append(BatchRowResult(index=index, status="rejected", id=event_id, error=f"Failed to publish to the broker: {str(error)}"))
+
+@router.post("/events/batch", response_model=BatchResponse, tags=["input_event"])
+async def create_events_batch(request: Request):
+    """Accept a JSON array of events, or one event per line with Content-Type: application/x-ndjson."""
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith(("application/x-ndjson", "application/ndjson")):
+        rows = read_ndjson_rows(request)
+    else:
+        rows = read_json_rows(request)
+
+    results = []
+    pending = []
+    index = 0
+
+    async for row in rows:
+        # Earlier rows may already be published, so rows over the limit are
+        # rejected one by one instead of failing the whole request.
+        if index >= EVENTS_BATCH_MAX_ROWS:
+            results.append(BatchRowResult(index=index, status="rejected", error=f"Batch exceeds {EVENTS_BATCH_MAX_ROWS} events"))
+            index += 1
+            continue
+
+        try:
+            if isinstance(row, bytes):
+                row = json.loads(row)
+            event = Event.model_validate(row)
+            event_dict = event.dict()
+            pending.append((index, event_dict["id"], event_dict["hotel_id"], json.dumps(event_dict, cls=DateTimeEncoder)))
+        except (ValueError, TypeError, ValidationError) as e:
+            results.append(BatchRowResult(index=index, status="rejected", error=str(e)))
+        index += 1
+
+        # Publish while the rest of the body is still being read.
+        if len(pending) >= EVENTS_BATCH_PUBLISH_SIZE:
+            await publish_rows(pending, results)
+            pending = []
+
+    if pending:
+        await publish_rows(pending, results)
+
+    results.sort(key=lambda result: result.index)
+    accepted = sum(1 for result in results if result.status == "accepted")
+    return BatchResponse(accepted=accepted, rejected=len(results) - accepted, results=results)
@@ -0,0 +1,23 @@
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from monitoring.metrics import BROKER_QUEUE_MESSAGES
+from queuemq.broker import broker
+import asyncio
+import logging
+
+router = APIRouter()
+
+logger = logging.getLogger(__name__)
+
+BACKLOG_TIMEOUT = 2
+
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    # How far the consumers are behind; a scrape still answers if the broker does not.
+    try:
+        backlog = await asyncio.wait_for(broker.backlog(), timeout=BACKLOG_TIMEOUT)
+        for partition, messages in backlog.items():
+            BROKER_QUEUE_MESSAGES.labels(str(partition)).set(messages)
+    except Exception as e:
+        logger.error(f"Failed to read the broker backlog: {str(e)}")
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
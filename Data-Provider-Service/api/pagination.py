@@ -0,0 +1,89 @@
+import base64
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from bson.errors import InvalidId
+from database.event_schema import field, parse_timestamp
+
+# Keyset order used by GET /events. _id breaks ties between events that share a timestamp.
+EVENT_SORT = [(field("timestamp"), 1), ("_id", 1)]
+# GET /events?order=ingest: the order events were stored in. The consumer's
+# upserts get their ObjectId from mongod, so _id grows with ingest time
+# whatever timestamp the client put on the event.
+INGEST_SORT = [("_id", 1)]
+# An _id is assigned before its write commits, so a smaller _id can become
+# visible after a larger one. Ingest pages stop this far behind now.
+EVENTS_INGEST_SETTLE_MS = int(os.getenv("EVENTS_INGEST_SETTLE_MS", 2000))
+
+class InvalidCursor(ValueError):
+    pass
+
+def encode_cursor(document):
+    timestamp = document.get(field("timestamp"))
+    if isinstance(timestamp, datetime):
+        payload = [timestamp.isoformat(), str(document["_id"])]
+    else:
+        # A version 1 document not migrated yet: its stored value is kept as
+        # is, since it sorts before every BSON date.
+        payload = [timestamp, str(document["_id"]), 1]
+    payload = json.dumps(payload, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    """Timestamp and _id of a cursor, and whether the timestamp is a version 1 stored value."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, object_id, *stored = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if stored:
+            return timestamp, ObjectId(object_id), True
+        # Cursors issued before schema version 2 carry the stored ISO string; both decode to a date.
+        return parse_timestamp(timestamp), ObjectId(object_id), False
+    except (ValueError, TypeError, AttributeError, InvalidId) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor}") from e
+
+def apply_cursor(query, cursor):
+    timestamp, object_id, stored = decode_cursor(cursor)
+    name = field("timestamp")
+    if stored:
+        # BSON sorts missing values first, then strings, then dates: every
+        # migrated or new event comes after a version 1 one.
+        later = {name: {"$gt": timestamp}} if timestamp is not None else {name: {"$type": "string"}}
+        after = {
+            "$or": [
+                later,
+                {name: timestamp, "_id": {"$gt": object_id}},
+                {name: {"$type": "date"}},
+            ]
+        }
+    else:
+        after = {
+            "$or": [
+                {name: {"$gt": timestamp}},
+                {name: timestamp, "_id": {"$gt": object_id}},
+            ]
+        }
+    if not query:
+        return after
+    return {"$and": [query, after]}
+
+def encode_ingest_cursor(document):
+    payload = json.dumps([str(document["_id"])], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def ingest_horizon():
+    """Smallest _id not served yet by ingest-order pages; ObjectIds have second resolution."""
+    return ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(milliseconds=EVENTS_INGEST_SETTLE_MS))
+
+def apply_ingest_cursor(query, cursor, horizon):
+    ids = {"$lt": horizon}
+    if cursor:
+        try:
+            padded = cursor + "=" * (-len(cursor) % 4)
+            (object_id,) = json.loads(base64.urlsafe_b64decode(padded.encode()))
+            ids["$gt"] = ObjectId(object_id)
+        except (ValueError, TypeError, AttributeError, InvalidId) as e:
+            raise InvalidCursor(f"Invalid cursor: {cursor}") from e
+    if not query:
+        return {"_id": ids}
+    return {"$and": [query, {"_id": ids}]}
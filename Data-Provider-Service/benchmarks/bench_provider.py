@@ -0,0 +1,131 @@
+"""Offline benchmarks of the Data Provider ingest and read paths.
+
+MongoDB is replaced by mongomock_motor and RabbitMQ by the in-memory broker,
+so the numbers measure this service's own code: request handling,
+validation, serialization and the consumer's batching. They are compared
+with the JSON baseline in benchmarks/baselines. They are smoke numbers for
+catching regressions, not comparable with a deployment against real servers.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# benchmark_baseline.py lives at the repository root and is shared with the other service.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+# Settings are read at import, so the in-memory broker is selected first.
+for name, value in {
+    "MONGODB_COLLECTION": "events",
+    "BROKER_BACKEND": "memory",
+    # Unbounded, so every posted event waits for the consumer benchmark.
+    "BROKER_MEMORY_QUEUE_SIZE": "0",
+}.items():
+    os.environ.setdefault(name, value)
+
+from httpx import ASGITransport, AsyncClient
+from mongomock_motor import AsyncMongoMockClient
+from benchmark_baseline import report, save_baseline
+from database import mongodb
+from database.event_schema import FIELD_NAMES
+from mongo_indexes import EVENT_INDEXES, rename_index_fields
+from queuemq.broker import broker
+from event.provider_consumer import CONSUMER_BATCH_SIZE, batch_callback
+from dataprovider import app
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "provider.json")
+
+def sample_event(i):
+    timestamp = datetime(2024, 1, 1) + timedelta(minutes=i)
+    return {
+        "id": i + 1,
+        "hotel_id": i % 20,
+        "timestamp": timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        "rpg_status": 1 if i % 5 else 2,
+        "room_id": str(100 + i % 50),
+        "night_of_stay": (timestamp.date() + timedelta(days=random.randint(0, 90))).isoformat()
+    }
+
+async def bench_post_events(client, events, concurrency):
+    slots = asyncio.Semaphore(concurrency)
+
+    async def post(event):
+        async with slots:
+            response = await client.post("/events", json=event)
+            response.raise_for_status()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(post(event) for event in events))
+    return len(events) / (time.perf_counter() - started)
+
+async def bench_consumer():
+    messages = []
+    for queue in broker.queues.values():
+        while not queue.empty():
+            messages.append(queue.get_nowait())
+    started = time.perf_counter()
+    for start in range(0, len(messages), CONSUMER_BATCH_SIZE):
+        await batch_callback(messages[start:start + CONSUMER_BATCH_SIZE])
+    return len(messages) / (time.perf_counter() - started)
+
+async def bench_get_events(client, limit, repeat):
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        response = await client.get("/events", params={"limit": limit})
+        timings.append(time.perf_counter() - started)
+        response.raise_for_status()
+    return statistics.median(timings) * 1000
+
+async def run(args):
+    random.seed(1)
+    mongodb.db.client = AsyncMongoMockClient()
+    mongodb.db.db = mongodb.db.client["benchmark"]
+    collection = mongodb.db.db[os.environ["MONGODB_COLLECTION"]]
+    await mongodb.ensure_indexes(collection, rename_index_fields(EVENT_INDEXES, FIELD_NAMES))
+
+    results = {}
+    events = [sample_event(i) for i in range(args.events)]
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://benchmark") as client:
+        results["post_events_per_s"] = await bench_post_events(client, events, args.concurrency)
+        results["consumer_ingest_per_s"] = await bench_consumer()
+        for limit in args.limits:
+            results[f"get_events_{limit}_ms"] = await bench_get_events(client, limit, args.repeat)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark POST /events, the consumer and GET /events without MongoDB or RabbitMQ.")
+    parser.add_argument("--events", type=int, default=1000, help="Events posted and then consumed; mongomock scans the collection on every upsert, so keep it small")
+    parser.add_argument("--concurrency", type=int, default=50, help="POST /events requests in flight")
+    parser.add_argument("--limits", type=int, nargs="+", default=[10, 100, 1000], help="GET /events page sizes")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per page size, the median is reported")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative slowdown against the baseline that counts as a regression")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--check", action="store_true", help="Exit with an error if a metric regressed")
+    args = parser.parse_args()
+
+    # The request and consumer logs would dominate the timings.
+    sys.stdout, stdout = open(os.devnull, "w"), sys.stdout
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    options = {name: value for name, value in vars(args).items() if name not in ("tolerance", "save_baseline", "check")}
+    regressions = report(BASELINE_PATH, results, args.tolerance, options)
+    if args.save_baseline:
+        save_baseline(BASELINE_PATH, results, options)
+    if regressions and args.check:
+        raise SystemExit(f"Regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+
+if __name__ == "__main__":
+    main()
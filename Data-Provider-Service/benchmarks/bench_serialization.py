@@ -0,0 +1,76 @@
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+from datetime import date, datetime, timedelta
+from typing import List
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orjson
+from bson import ObjectId
+from pydantic import TypeAdapter
+from database.event_schema import SCHEMA_VERSION, field, from_document, to_row
+from model.data_provider_model import Event
+
+EVENTS_ADAPTER = TypeAdapter(List[Event])
+
+def stored_events(rows):
+    """Documents shaped like the events collection, without touching MongoDB."""
+    start = datetime(2024, 1, 1)
+    night = date(2024, 1, 1).toordinal()
+    return [
+        {
+            "_id": ObjectId(),
+            field("id"): i,
+            field("hotel_id"): i % 50,
+            field("timestamp"): start + timedelta(seconds=i),
+            field("rpg_status"): 1 + i % 2,
+            field("room_id"): str(i % 300),
+            field("night_of_stay"): night + i % 365,
+            field("schema_version"): SCHEMA_VERSION,
+        }
+        for i in range(rows)
+    ]
+
+def model_path(documents):
+    # What GET /events did before: build an Event per row, let response_model
+    # validate the list again, then encode it the way JSONResponse does.
+    events = [Event(**from_document(document)) for document in documents]
+    content = EVENTS_ADAPTER.dump_python(EVENTS_ADAPTER.validate_python(events), mode="json")
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+def fast_path(documents):
+    return orjson.dumps([to_row(document) for document in documents])
+
+def measure(function, documents, repeat):
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        body = function(documents)
+        timings.append(time.perf_counter() - started)
+    return min(timings), len(body)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the GET /events serialization paths.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000], help="Result sizes to encode")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per size, the fastest one is reported")
+    args = parser.parse_args()
+
+    check = stored_events(100)
+    if json.loads(model_path(check)) != json.loads(fast_path(check)):
+        raise SystemExit("The fast path does not produce the same rows as the model path")
+
+    print(f"{'rows':>9} {'model s':>9} {'fast s':>9} {'speedup':>8} {'MB':>8}")
+    for rows in args.rows:
+        documents = stored_events(rows)
+        model_seconds, size = measure(model_path, documents, args.repeat)
+        fast_seconds, _ = measure(fast_path, documents, args.repeat)
+        print(f"{rows:>9} {model_seconds:>9.3f} {fast_seconds:>9.3f} {model_seconds / fast_seconds:>7.1f}x {size / 1e6:>8.1f}")
+        del documents
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+from datetime import date, datetime, timezone
+from dotenv import load_dotenv
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from mongo_indexes import EVENT_COMPACT_FIELDS
+
+load_dotenv(override=True)
+
+# Version 1 stored timestamp and night_of_stay as ISO strings.
+# Version 2 stores timestamp as a BSON date and night_of_stay as a day ordinal (date.toordinal()).
+SCHEMA_VERSION = 2
+
+EVENTS_COMPACT_FIELDS = os.getenv("EVENTS_COMPACT_FIELDS", "false").lower() == "true"
+
+FIELD_NAMES = EVENT_COMPACT_FIELDS if EVENTS_COMPACT_FIELDS else {name: name for name in EVENT_COMPACT_FIELDS}
+LONG_NAMES = {short: name for name, short in EVENT_COMPACT_FIELDS.items()}
+
+def field(name):
+    """Name under which `name` is stored in the configured schema."""
+    return FIELD_NAMES[name]
+
+def legacy_schema(state):
+    """Whether stored events can still be in schema version 1, until migrate_events.py has finished."""
+    return state.get("schema_version", 1) < SCHEMA_VERSION
+
+def field_expression(name, legacy=False):
+    """Aggregation expression reading `name`, also under the long name version 1 documents keep when `legacy`."""
+    if legacy and field(name) != name:
+        return {"$ifNull": [f"${field(name)}", f"${name}"]}
+    return f"${field(name)}"
+
+def to_utc(value):
+    # BSON dates carry no offset; everything is stored and compared as naive UTC.
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def parse_timestamp(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return to_utc(value)
+
+def to_document(event):
+    document = {
+        "id": event.id,
+        "hotel_id": event.hotel_id,
+        "timestamp": to_utc(event.timestamp),
+        "rpg_status": event.rpg_status,
+        "room_id": event.room_id,
+        "night_of_stay": event.night_of_stay.toordinal(),
+        "schema_version": SCHEMA_VERSION,
+    }
+    return {field(name): value for name, value in document.items()}
+
+def from_document(document):
+    """Map a stored event of any schema version or naming back to Event fields."""
+    event = {LONG_NAMES.get(name, name): value for name, value in document.items()}
+
+    if event.get("schema_version", 1) == 1:
+        event["timestamp"] = parse_timestamp(event["timestamp"])
+        event["night_of_stay"] = date.fromisoformat(event["night_of_stay"])
+    else:
+        event["night_of_stay"] = date.fromordinal(event["night_of_stay"])
+
+    event.pop("schema_version", None)
+    return event
+
+# Day ordinal of 1970-01-01, used to turn a stored night_of_stay back into a date inside pipelines.
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+EPOCH = datetime(1970, 1, 1)
+
+def night_of_stay_as_date():
+    """Aggregation expression that converts the stored day ordinal into a BSON date."""
+    return {"$add": [EPOCH, {"$multiply": [{"$subtract": [f"${field('night_of_stay')}", EPOCH_ORDINAL]}, 86400000]}]}
+
+EVENT_FIELDS = ("id", "hotel_id", "timestamp", "rpg_status", "room_id", "night_of_stay")
+
+def to_row(document):
+    """Response row of a stored event in Event field order, without building an Event.
+
+    Events were validated when they were stored, so reads only map names and types.
+    """
+    if document.get(field("schema_version")) != SCHEMA_VERSION:
+        event = from_document(document)
+        return {name: event.get(name) for name in EVENT_FIELDS}
+    return {
+        "id": document.get(field("id")),
+        "hotel_id": document[field("hotel_id")],
+        "timestamp": document[field("timestamp")],
+        "rpg_status": document[field("rpg_status")],
+        "room_id": document[field("room_id")],
+        "night_of_stay": date.fromordinal(document[field("night_of_stay")]),
+    }
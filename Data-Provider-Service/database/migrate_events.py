@@ -0,0 +1,140 @@
+import argparse
+import asyncio
+import logging
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pydantic import ValidationError
+from pymongo import DeleteOne, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from dotenv import load_dotenv
+from database.mongodb import bump_events_version, connect_to_mongo, close_mongo_connection, db, mark_schema_current
+from database.event_schema import SCHEMA_VERSION, field, from_document, to_document, to_row
+from model.data_provider_model import Event
+from model.snowflake import event_ids
+
+load_dotenv(override=True)
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# The dashboards share the database; their sync state is where rebuilds are requested.
+MONGODB_COLLECTION_DASHBOARD_SYNC = os.getenv("MONGODB_COLLECTION_DASHBOARD_SYNC", "dashboard_sync")
+DASHBOARD_SYNC_STATE_ID = "events"
+
+async def migrate(batch_size, pause):
+    """Rewrite events that are not stored in the current schema, in _id order.
+
+    The collection stays online: each document is replaced only if it is still
+    outdated, and new events written during the run already use the current schema.
+    Reads match both versions until no outdated document is left.
+    """
+    collection = db.db[os.getenv("MONGODB_COLLECTION")]
+    outdated = {field("schema_version"): {"$ne": SCHEMA_VERSION}}
+    last_id = None
+    migrated = 0
+    skipped = 0
+
+    while True:
+        query = dict(outdated)
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        documents = await collection.find(query, sort=[("_id", 1)], limit=batch_size).to_list(length=None)
+        if not documents:
+            break
+
+        operations = []
+        for document in documents:
+            try:
+                replacement = to_document(Event(**from_document(document)))
+            except (KeyError, ValueError, TypeError, ValidationError) as e:
+                logger.error(f"Skipping event {document['_id']}: {str(e)}")
+                skipped += 1
+                continue
+            operations.append(ReplaceOne({"_id": document["_id"], **outdated}, replacement))
+        last_id = documents[-1]["_id"]
+
+        if operations:
+            try:
+                result = await collection.bulk_write(operations, ordered=False)
+                migrated += result.modified_count
+            except BulkWriteError as bwe:
+                migrated += bwe.details.get("nModified", 0)
+                logger.error(f"Bulk write errors: {bwe.details.get('writeErrors')}")
+        logger.info(f"Migrated {migrated} events so far (last _id {last_id})")
+
+        if pause:
+            await asyncio.sleep(pause)
+
+    if migrated:
+        await bump_events_version()
+    logger.info(f"Migration to schema version {SCHEMA_VERSION} finished: {migrated} migrated, {skipped} skipped")
+
+    if await collection.find_one(outdated, {"_id": 1}) is not None:
+        logger.warning("Some events are still outdated, reads keep matching schema version 1; run the migration again")
+        return
+    await mark_schema_current()
+    if migrated:
+        # Rewritten events keep their _id, so the dashboards' ingest sync never reads them again.
+        await db.db[MONGODB_COLLECTION_DASHBOARD_SYNC].update_one(
+            {"_id": DASHBOARD_SYNC_STATE_ID},
+            {"$set": {"rebuild_requested": True}},
+            upsert=True
+        )
+        logger.info("Requested a full dashboard rebuild")
+
+async def dedupe_ids():
+    """Make event ids unique, so the unique id index can be built.
+
+    Ids used to be the creation second, and redeliveries were stored again.
+    A copy with the same content as an earlier event of its id is a
+    redelivery and is deleted; an event that only shares the id gets a new
+    one. Dashboards have to be rebuilt afterwards to pick up the new ids.
+    """
+    collection = db.db[os.getenv("MONGODB_COLLECTION")]
+    pipeline = [
+        {"$group": {"_id": f"${field('id')}", "documents": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ]
+    deleted = 0
+    reassigned = 0
+
+    async for group in collection.aggregate(pipeline, allowDiskUse=True):
+        documents = await collection.find({"_id": {"$in": group["documents"]}}, sort=[("_id", 1)]).to_list(length=None)
+        kept = [to_row(documents[0])]
+        operations = []
+        for document in documents[1:]:
+            row = to_row(document)
+            if row in kept:
+                operations.append(DeleteOne({"_id": document["_id"]}))
+                deleted += 1
+            else:
+                operations.append(UpdateOne({"_id": document["_id"]}, {"$set": {field("id"): event_ids.next_id()}}))
+                kept.append(row)
+                reassigned += 1
+        await collection.bulk_write(operations, ordered=False)
+
+    if deleted or reassigned:
+        # Cached pages still show the old ids.
+        await bump_events_version()
+    logger.info(f"Deduplicated event ids: {deleted} redelivered copies deleted, {reassigned} events got a new id")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Migrate stored events to the current schema version.")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Documents rewritten per bulk write")
+    parser.add_argument("--pause-ms", type=int, default=0, help="Pause between batches to limit load on a live cluster")
+    parser.add_argument("--dedupe-ids", action="store_true", help="Only make event ids unique, before the unique id index is built")
+    args = parser.parse_args()
+
+    await connect_to_mongo()
+    try:
+        if args.dedupe_ids:
+            await dedupe_ids()
+        else:
+            await migrate(args.batch_size, args.pause_ms / 1000)
+    finally:
+        close_mongo_connection()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,18 +1,46 @@
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
 from dotenv import load_dotenv
-import time
 import os
+import sys
 import asyncio
+from datetime import datetime
+
+# mongo_indexes.py lives at the repository root and is shared with rpgprep.py.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from pymongo.errors import OperationFailure
+from mongo_indexes import plan_indexes, unique_index_conflict, without_unique
+from database.event_schema import SCHEMA_VERSION
+from monitoring.metrics import MONGO_LATENCY
 
 load_dotenv(override=True)
 
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", 100))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", 0))
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS", 2000))
+MONGODB_OP_TIMEOUT_MS = int(os.getenv("MONGODB_OP_TIMEOUT_MS", 10000))
+# Version of the stored events, bumped by tools that rewrite them in place.
+MONGODB_COLLECTION_EVENTS_STATE = os.getenv("MONGODB_COLLECTION_EVENTS_STATE", "events_state")
+EVENTS_STATE_ID = "events"
+
 class MongoDB:
-    client: MongoClient = None
+    client: AsyncIOMotorClient = None
     db = None
 
 db = MongoDB()
 
-def connect_to_mongo():
+def create_client(mongodb_url):
+    # Request concurrency is bounded by the pool: once maxPoolSize connections
+    # are checked out, callers wait up to waitQueueTimeoutMS for a free one.
+    return AsyncIOMotorClient(
+        mongodb_url,
+        maxPoolSize=MONGODB_MAX_POOL_SIZE,
+        minPoolSize=MONGODB_MIN_POOL_SIZE,
+        waitQueueTimeoutMS=MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+        serverSelectionTimeoutMS=5000
+    )
+
+async def connect_to_mongo():
     max_retries = 5
     retry_delay = 5  # seconds
 
@@ -22,10 +50,10 @@ def connect_to_mongo():
             mongodb_db = os.getenv("MONGODB_DB")
             print(f"MONGODB_URL: {mongodb_url}")
             print(f"MONGODB_DB: {mongodb_db}")
-            print(f"Attempting to connect to MongoDB with URL: {mongodb_url}")
-            db.client = MongoClient(mongodb_url, serverSelectionTimeoutMS=5000)
+            print(f"Attempting to connect to MongoDB with URL: {mongodb_url} (pool size {MONGODB_MAX_POOL_SIZE})")
+            db.client = create_client(mongodb_url)
             print("Initial connection successful, attempting to ping...")
-            db.client.admin.command('ping')
+            await db.client.admin.command('ping')
             print("Ping successful")
             db.db = db.client[mongodb_db]
             print("Successfully connected to MongoDB and selected database")
@@ -37,7 +65,7 @@ def connect_to_mongo():
             print(f"Error details: {e.args}")
             if attempt < max_retries - 1:
                 print(f"Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
+                await asyncio.sleep(retry_delay)
             else:
                 print("Max retries reached. Unable to connect to MongoDB.")
                 raise
@@ -46,14 +74,81 @@ def close_mongo_connection():
     if db.client:
         db.client.close()
 
-async def run_mongo_task(func):
-    return await asyncio.to_thread(func)
+async def ensure_indexes(collection, spec, retired=()):
+    """Apply an index spec; returns the unique indexes stored duplicates forced to build without uniqueness."""
+    to_create, to_drop = plan_indexes(spec, await collection.index_information(), retired)
+    for name in to_drop:
+        print(f"Dropping index: {name}")
+        await collection.drop_index(name)
+    if not to_create:
+        print(f"Indexes of {collection.name} are up to date")
+        return []
+    print(f"Creating indexes: {', '.join(index.document['name'] for index in to_create)}")
+    try:
+        await collection.create_indexes(to_create)
+    except OperationFailure as e:
+        name = unique_index_conflict(spec, e)
+        if name is None:
+            raise
+        print(f"Stored documents of {collection.name} share keys of unique index {name}, building it without uniqueness")
+        return [name] + await ensure_indexes(collection, without_unique(spec, name), retired)
+    return []
+
+async def with_timeout(awaitable, timeout_ms=None, operation="other"):
+    with MONGO_LATENCY.labels(operation).time():
+        return await asyncio.wait_for(awaitable, timeout=(timeout_ms or MONGODB_OP_TIMEOUT_MS) / 1000)
 
 async def insert_one(collection, document):
-    return await run_mongo_task(lambda: db.db[collection].insert_one(document))
+    return await with_timeout(db.db[collection].insert_one(document), operation="insert_one")
+
+async def update_one(collection, query, update, upsert=False):
+    return await with_timeout(db.db[collection].update_one(query, update, upsert=upsert), operation="update_one")
+
+async def bulk_write(collection, operations, ordered=False):
+    return await with_timeout(db.db[collection].bulk_write(operations, ordered=ordered), operation="bulk_write")
 
 async def find_one(collection, query):
-    return await run_mongo_task(lambda: db.db[collection].find_one(query))
+    return await with_timeout(db.db[collection].find_one(query, max_time_ms=MONGODB_OP_TIMEOUT_MS), operation="find_one")
+
+async def find(collection, query, sort=None, limit=0, projection=None):
+    cursor = db.db[collection].find(query, projection, sort=sort, limit=limit, max_time_ms=MONGODB_OP_TIMEOUT_MS)
+    return await with_timeout(cursor.to_list(length=None), operation="find")
+
+async def events_state():
+    return await find_one(MONGODB_COLLECTION_EVENTS_STATE, {"_id": EVENTS_STATE_ID}) or {}
+
+async def bump_events_version():
+    """Invalidate every events ETag after stored events were changed or deleted rather than added."""
+    await update_one(
+        MONGODB_COLLECTION_EVENTS_STATE,
+        {"_id": EVENTS_STATE_ID},
+        {"$inc": {"version": 1}, "$set": {"updated_at": datetime.utcnow()}},
+        upsert=True
+    )
+
+async def mark_schema_current():
+    """Record that every stored event is in the current schema, so reads stop matching version 1 documents."""
+    await update_one(
+        MONGODB_COLLECTION_EVENTS_STATE,
+        {"_id": EVENTS_STATE_ID},
+        {"$set": {"schema_version": SCHEMA_VERSION}},
+        upsert=True
+    )
+
+async def estimated_count(collection):
+    # Read from collection metadata, no scan.
+    return await with_timeout(db.db[collection].estimated_document_count(), operation="estimated_count")
+
+async def aggregate(collection, pipeline):
+    cursor = db.db[collection].aggregate(pipeline, allowDiskUse=True, maxTimeMS=MONGODB_OP_TIMEOUT_MS)
+    return await with_timeout(cursor.to_list(length=None), operation="aggregate")
 
-async def find(collection, query):
-    return await run_mongo_task(lambda: list(db.db[collection].find(query)))
\ No newline at end of file
+async def iterate(collection, query, sort=None, limit=0, batch_size=500):
+    # Documents are yielded as each batch arrives so callers can stream
+    # results without materializing the whole result set in memory.
+    cursor = db.db[collection].find(query, sort=sort, limit=limit, batch_size=batch_size)
+    try:
+        async for document in cursor:
+            yield document
+    finally:
+        await cursor.close()
@@ -7,14 +7,20 @@ from contextlib import asynccontextmanager
 import asyncio
 import os
 from api.dprovider import router as dprovider_router
-from database.mongodb import connect_to_mongo, close_mongo_connection, db
-from queuemq.broker import rabbitmq_broker
+from api.metrics import router as metrics_router
+from monitoring.metrics import track_request
+from database.mongodb import connect_to_mongo, close_mongo_connection, db, ensure_indexes, mark_schema_current
+from queuemq.broker import broker, RabbitMQBroker
 from dotenv import load_dotenv
 from event.provider_consumer import start_consuming
-from pymongo import ASCENDING
+from database.event_schema import FIELD_NAMES
+from mongo_indexes import EVENT_INDEXES, RETIRED_EVENT_INDEXES, rename_index_fields
 
 load_dotenv(override=True)
 
+# false when the events are consumed by standalone workers (event/provider_consumer.py).
+CONSUMER_IN_PROCESS = os.getenv("CONSUMER_IN_PROCESS", "true").lower() == "true"
+
 consumer_task = None
 
 async def setup_mongodb():
@@ -23,7 +29,7 @@ async def setup_mongodb():
     
     print(f"Attempting to list database names...")
     try:
-        db_names = db.client.list_database_names()
+        db_names = await db.client.list_database_names()
         print(f"Successfully listed database names: {db_names}")
     except Exception as e:
         print(f"Error listing database names: {str(e)}")
@@ -34,7 +40,7 @@ async def setup_mongodb():
     
     print(f"Attempting to list collection names...")
     try:
-        collection_names = db.db.list_collection_names()
+        collection_names = await db.db.list_collection_names()
         print(f"Successfully listed collection names: {collection_names}")
     except Exception as e:
         print(f"Error listing collection names: {str(e)}")
@@ -42,34 +48,26 @@ async def setup_mongodb():
 
     if mongodb_collection not in collection_names:
         print(f"Creating collection: {mongodb_collection}")
-        db.db.create_collection(mongodb_collection)
+        await db.db.create_collection(mongodb_collection)
     
     collection = db.db[mongodb_collection]
     
-    indexes_to_create = [
-        ("hotel_id", ASCENDING),
-        ("timestamp", ASCENDING),
-        ("rpg_status", ASCENDING),
-        ("room_id", ASCENDING),
-        ("night_of_stay", ASCENDING)
-    ]
-    
-    existing_indexes = collection.index_information()
-    
-    for field, direction in indexes_to_create:
-        index_name = f"{field}_1"
-        if index_name not in existing_indexes:
-            print(f"Creating index for field: {field}")
-            collection.create_index([(field, direction)])
-        else:
-            print(f"Index already exists for field: {field}")
+    relaxed = await ensure_indexes(collection, rename_index_fields(EVENT_INDEXES, FIELD_NAMES), RETIRED_EVENT_INDEXES)
+    if "id" in relaxed:
+        # Events stored before ids were unique can share an id. Upserts still
+        # need the index to find ids, so it is built without uniqueness.
+        print("Stored events share ids, run database/migrate_events.py --dedupe-ids to make the id index unique")
+
+    # A new deployment has no version 1 events to migrate.
+    if await collection.estimated_document_count() == 0:
+        await mark_schema_current()
 
 async def setup_rabbitmq():
     exchange_name = os.getenv("RABBITMQ_EXCHANGE")
     routing_key = os.getenv("RABBITMQ_ROUTING_KEY")
     queue_name = os.getenv("RABBITMQ_QUEUE")
 
-    channel = await rabbitmq_broker.connection.channel()
+    channel = await broker.connection.channel()
     
     exchange = await channel.declare_exchange(
         exchange_name, 
@@ -78,32 +76,32 @@ async def setup_rabbitmq():
     )
     print(f"Declared exchange: {exchange_name}")
 
-    queue = await channel.declare_queue(queue_name, durable=True)
-    print(f"Declared queue: {queue_name}")
-
-    await queue.bind(exchange, routing_key)
-    print(f"Bound queue {queue_name} to exchange {exchange_name} with routing key {routing_key}")
+    for partition in await broker.declare_partitions(channel, exchange):
+        print(f"Bound queue {broker.partition_name(queue_name, partition)} to exchange {exchange_name} with routing key {broker.partition_name(routing_key, partition)}")
 
     await channel.close()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global consumer_task
-    connect_to_mongo()
+    await connect_to_mongo()
     await setup_mongodb()
     try:
-        await rabbitmq_broker.connect()
-        await setup_rabbitmq()
-        consumer_task = asyncio.create_task(start_consuming())
-        print("RabbitMQ consumer started in the background")
+        await broker.connect()
+        if isinstance(broker, RabbitMQBroker):
+            await setup_rabbitmq()
+        # The in-memory queue can only be consumed by this process.
+        if CONSUMER_IN_PROCESS or not isinstance(broker, RabbitMQBroker):
+            consumer_task = asyncio.create_task(start_consuming())
+            print(f"{type(broker).__name__} consumer started in the background")
     except Exception as e:
-        print(f"Failed to connect to RabbitMQ: {str(e)}")
-        print("The application will continue without RabbitMQ connection.")
+        print(f"Failed to connect to the broker: {str(e)}")
+        print("The application will continue without a broker connection.")
     
     yield
     
     close_mongo_connection()
-    await rabbitmq_broker.close()
+    await broker.close()
     if consumer_task:
         consumer_task.cancel()
         try:
@@ -147,6 +145,8 @@ app = FastAPI(lifespan=lifespan, docs_url="/documentation", openapi_tags=tags_me
             })
 
 app.include_router(dprovider_router)
+app.include_router(metrics_router)
+app.middleware("http")(track_request)
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,35 +1,66 @@
+import argparse
 import json
 import asyncio
+import multiprocessing
 import os
 import sys
 import logging
 from dotenv import load_dotenv
-from datetime import datetime, date
+from prometheus_client import start_http_server
+from pydantic import ValidationError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from database.mongodb import connect_to_mongo, close_mongo_connection, insert_one
+from database.mongodb import connect_to_mongo, close_mongo_connection, bulk_write, find, update_one
+from database.event_schema import field, to_document, to_row
 from model.data_provider_model import Event
-from queuemq.broker import rabbitmq_broker
+from queuemq.broker import broker
+from monitoring.metrics import CONSUMER_BATCH_SIZES, CONSUMER_INSERT_RETRIES, CONSUMER_MESSAGES
 
 load_dotenv(override=True)
 logger = logging.getLogger(__name__)
 
-class DateTimeEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, (datetime, date)):
-            return obj.isoformat()
-        return json.JSONEncoder.default(self, obj)
+CONSUMER_MODE = os.getenv("CONSUMER_MODE", "batch")
+CONSUMER_BATCH_SIZE = int(os.getenv("CONSUMER_BATCH_SIZE", 200))
+CONSUMER_BATCH_LINGER = int(os.getenv("CONSUMER_BATCH_LINGER_MS", 50)) / 1000
+# Standalone workers split the partition queues between them: worker i of
+# CONSUMER_WORKERS reads every partition p with p % CONSUMER_WORKERS == i.
+CONSUMER_WORKERS = int(os.getenv("CONSUMER_WORKERS", 1))
+CONSUMER_WORKER_INDEX = int(os.getenv("CONSUMER_WORKER_INDEX", 0))
+# Batches one worker stores at the same time, across its partitions.
+CONSUMER_CONCURRENCY = int(os.getenv("CONSUMER_CONCURRENCY", 4))
+# Prometheus port of a standalone worker (plus its process number); 0 disables it.
+CONSUMER_METRICS_PORT = int(os.getenv("CONSUMER_METRICS_PORT", 0))
+
+def event_upsert(document):
+    # Stored events never change, so a redelivered id matches the stored
+    # document and leaves it as it is; no read is needed to tell them apart.
+    return {field("id"): document[field("id")]}, {"$setOnInsert": document}
+
+async def count_conflicts(collection, documents):
+    """Log and count events that were not stored because another event already holds their id.
+
+    Only runs for ids the upsert found stored, which are normally redeliveries
+    of the same event. A client-supplied id that collides with a different
+    event cannot be stored under the unique index, but is not dropped silently.
+    """
+    if not documents:
+        return 0
+    stored = {
+        document[field("id")]: to_row(document)
+        for document in await find(collection, {field("id"): {"$in": [document[field("id")] for document in documents]}})
+    }
+    conflicts = [document[field("id")] for document in documents if stored.get(document[field("id")], to_row(document)) != to_row(document)]
+    if conflicts:
+        logger.warning(f"Dropped {len(conflicts)} events whose id is already used by a different event: {conflicts[:10]}")
+        CONSUMER_MESSAGES.labels("conflict").inc(len(conflicts))
+    return len(conflicts)
 
 async def callback(message):
-    event_dict = json.loads(message)
-    
-    if isinstance(event_dict["night_of_stay"], str):
-        event_dict["night_of_stay"] = date.fromisoformat(event_dict["night_of_stay"])
-    
-    event = Event(**event_dict)
-    
-    event_dict = json.loads(json.dumps(event.dict(), cls=DateTimeEncoder))
+    event = Event(**json.loads(message))
+    event_dict = to_document(event)
     
     collection = os.getenv("MONGODB_COLLECTION")
     max_retries = 5
@@ -37,29 +68,178 @@ async def callback(message):
 
     for attempt in range(max_retries):
         try:
-            result = await asyncio.wait_for(insert_one(collection, event_dict), timeout=5.0)
-            logger.info(f"Saved event with ID: {result.inserted_id}")
-            print(f"Saved event with ID: {result.inserted_id}")
+            result = await asyncio.wait_for(update_one(collection, *event_upsert(event_dict), upsert=True), timeout=5.0)
+            if result.upserted_id is None:
+                if not await count_conflicts(collection, [event_dict]):
+                    logger.info(f"Event {event.id} was already stored")
+                    CONSUMER_MESSAGES.labels("duplicate").inc()
+                break
+            logger.info(f"Saved event with ID: {result.upserted_id}")
+            print(f"Saved event with ID: {result.upserted_id}")
+            CONSUMER_MESSAGES.labels("stored").inc()
+            await fan_out([event])
+            break
+        except DuplicateKeyError:
+            # A concurrent upsert of the same id inserted it first.
+            CONSUMER_MESSAGES.labels("duplicate").inc()
             break
         except asyncio.TimeoutError:
             if attempt < max_retries - 1:
                 logger.warning(f"Timeout occurred. Retrying... (Attempt {attempt + 1}/{max_retries})")
+                CONSUMER_INSERT_RETRIES.inc()
                 await asyncio.sleep(retry_delay)
             else:
                 logger.error("Max retries reached. Failed to save event.")
                 print("Failed to save event due to timeout.")
+                CONSUMER_MESSAGES.labels("failed").inc()
         except Exception as e:
             logger.error(f"Error saving event: {str(e)}")
             print(f"Error saving event: {str(e)}")
+            CONSUMER_MESSAGES.labels("failed").inc()
+            break
+
+async def fan_out(events):
+    # The events are already stored; if the fan-out fails the dashboard's
+    # checkpoint poll still picks them up.
+    if not events:
+        return
+    try:
+        await broker.publish_events(events)
+    except Exception as e:
+        logger.error(f"Failed to fan out {len(events)} events: {str(e)}")
+
+async def batch_callback(messages):
+    """Store a batch of messages with one unordered bulk write of upserts on id.
+
+    Events whose id is already stored are acked without being written or
+    fanned out again, so a redelivered batch is stored exactly once. Returns
+    the indexes of the messages that could not be stored so the broker can
+    reject only those.
+    """
+    CONSUMER_BATCH_SIZES.observe(len(messages))
+    rejected = set()
+    events = []
+    documents = []
+    positions = []
+    seen = {}
+    duplicates = 0
+    conflicts = 0
+
+    for index, message in enumerate(messages):
+        try:
+            event = Event(**json.loads(message))
+        except (ValueError, TypeError, ValidationError) as e:
+            logger.error(f"Rejecting invalid event: {str(e)}")
+            rejected.add(index)
+            continue
+        document = to_document(event)
+        if event.id in seen:
+            if seen[event.id] != to_row(document):
+                logger.warning(f"Dropped event {event.id}: its id is used by a different event of the same batch")
+                CONSUMER_MESSAGES.labels("conflict").inc()
+                conflicts += 1
+            else:
+                duplicates += 1
+            continue
+        seen[event.id] = to_row(document)
+        documents.append(document)
+        events.append(event)
+        positions.append(index)
+
+    if not documents:
+        CONSUMER_MESSAGES.labels("rejected").inc(len(rejected))
+        CONSUMER_MESSAGES.labels("duplicate").inc(duplicates)
+        return rejected
+
+    collection = os.getenv("MONGODB_COLLECTION")
+    max_retries = 5
+    retry_delay = 1  # seconds
+    operations = [UpdateOne(*event_upsert(document), upsert=True) for document in documents]
+    inserted = set()
+
+    # Retrying is safe: upserts of ids a previous attempt stored match them.
+    for attempt in range(max_retries):
+        try:
+            result = await asyncio.wait_for(bulk_write(collection, operations), timeout=5.0)
+            inserted = set(result.upserted_ids)
+            logger.info(f"Saved batch of {len(inserted)} new events, {len(documents) - len(inserted)} already stored")
+            break
+        except BulkWriteError as bwe:
+            inserted = {upsert["index"] for upsert in bwe.details.get("upserted", [])}
+            # Duplicate keys come from a concurrent upsert that stored the id first.
+            errors = [error for error in bwe.details.get("writeErrors", []) if error.get("code") != 11000]
+            for error in errors:
+                rejected.add(positions[error["index"]])
+            logger.error(f"Saved batch with {len(errors)} write errors")
             break
+        except asyncio.TimeoutError:
+            if attempt < max_retries - 1:
+                logger.warning(f"Timeout occurred. Retrying... (Attempt {attempt + 1}/{max_retries})")
+                CONSUMER_INSERT_RETRIES.inc()
+                await asyncio.sleep(retry_delay)
+            else:
+                logger.error("Max retries reached. Failed to save batch.")
+                CONSUMER_MESSAGES.labels("failed").inc(len(messages))
+                raise
+
+    conflicts += await count_conflicts(collection, [
+        document for position, document in enumerate(documents)
+        if position not in inserted and positions[position] not in rejected
+    ])
+    CONSUMER_MESSAGES.labels("stored").inc(len(inserted))
+    CONSUMER_MESSAGES.labels("duplicate").inc(len(messages) - len(rejected) - len(inserted) - conflicts)
+    CONSUMER_MESSAGES.labels("rejected").inc(len(rejected))
+
+    await fan_out([event for position, event in enumerate(events) if position in inserted])
+    return rejected
+
+def worker_partitions(partitions, workers=CONSUMER_WORKERS, index=CONSUMER_WORKER_INDEX):
+    return [partition for partition in range(partitions) if partition % workers == index]
+
+def limited(handler, slots):
+    async def run(messages):
+        async with slots:
+            return await handler(messages)
+    return run
 
-async def start_consuming():
+async def consume(partitions=None, concurrency=CONSUMER_CONCURRENCY):
+    """Read the given partitions, by default the ones this worker owns, side by side.
+
+    Every partition has its own loop that stores one batch after the other,
+    so the events of a hotel are stored in the order they were published.
+    """
+    if partitions is None:
+        partitions = worker_partitions(broker.partitions)
+    if not partitions:
+        raise ValueError(f"No partitions to consume out of {broker.partitions}")
+
+    slots = asyncio.Semaphore(max(concurrency, 1))
+    if CONSUMER_MODE == "single":
+        loops = [broker.consume(limited(callback, slots), partition) for partition in partitions]
+    else:
+        loops = [
+            broker.consume_batch(limited(batch_callback, slots), CONSUMER_BATCH_SIZE, CONSUMER_BATCH_LINGER, partition)
+            for partition in partitions
+        ]
+
+    tasks = [asyncio.create_task(loop) for loop in loops]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+    finally:
+        # One failed partition restarts them all, so no loop is left running twice.
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def start_consuming(partitions=None, concurrency=CONSUMER_CONCURRENCY):
     max_retries = 10
     retry_delay = 5
 
     for attempt in range(max_retries):
         try:
-            await rabbitmq_broker.consume(callback)
+            await consume(partitions, concurrency)
         except asyncio.CancelledError:
             logger.error("Consumer was cancelled")
             break
@@ -71,9 +251,49 @@ async def start_consuming():
             else:
                 logger.error("Max retries reached. Giving up.")
 
-if __name__ == "__main__":
-    connect_to_mongo()
+async def main(partitions=None, concurrency=CONSUMER_CONCURRENCY):
+    await connect_to_mongo()
+    await broker.connect()
     try:
-        asyncio.run(start_consuming())
+        await start_consuming(partitions, concurrency)
     finally:
-        close_mongo_connection()
\ No newline at end of file
+        await broker.close()
+        close_mongo_connection()
+
+def run_worker(index, workers, concurrency, metrics_port):
+    partitions = worker_partitions(broker.partitions, workers, index)
+    print(f"Consumer worker {index} of {workers} reading partitions {partitions} with concurrency {concurrency}")
+    if metrics_port:
+        start_http_server(metrics_port)
+    asyncio.run(main(partitions, concurrency))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Store events from the broker, outside of the API process.")
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes to start on this host")
+    parser.add_argument("--workers", type=int, default=CONSUMER_WORKERS, help="Workers across all hosts and processes")
+    parser.add_argument("--worker-index", type=int, default=CONSUMER_WORKER_INDEX, help="Index of the first worker of this host")
+    parser.add_argument("--concurrency", type=int, default=CONSUMER_CONCURRENCY, help="Batches each worker stores at the same time")
+    args = parser.parse_args()
+    if args.worker_index + args.processes > args.workers:
+        parser.error(f"--worker-index {args.worker_index} with {args.processes} processes exceeds --workers {args.workers}")
+    if args.workers > broker.partitions:
+        parser.error(f"--workers {args.workers} is more than the {broker.partitions} partitions, raise CONSUMER_PARTITIONS")
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.processes == 1:
+        run_worker(args.worker_index, args.workers, args.concurrency, CONSUMER_METRICS_PORT)
+    else:
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(
+                target=run_worker,
+                args=(args.worker_index + number, args.workers, args.concurrency, CONSUMER_METRICS_PORT and CONSUMER_METRICS_PORT + number)
+            )
+            for number in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
\ No newline at end of file
@@ -1,15 +1,23 @@
 from pydantic import BaseModel, Field, field_validator
 from datetime import datetime, date
-from typing import Optional
+from typing import List, Optional
+from model.snowflake import event_ids
 
 class Event(BaseModel):
-    id: Optional[int] = Field(default_factory=lambda: int(datetime.now().timestamp()))
+    id: int = Field(default_factory=event_ids.next_id)
     hotel_id: int
     timestamp: datetime
     rpg_status: int = Field(..., ge=1, le=2)
     room_id: str
     night_of_stay: date
 
+    @field_validator('id', mode='before')
+    @classmethod
+    def assign_missing_id(cls, v):
+        # "id": null gets an id like an omitted one. The consumer upserts on
+        # id, so null ids would all collapse into one stored event.
+        return event_ids.next_id() if v is None else v
+
     @field_validator('timestamp', mode='before')
     @classmethod
     def parse_timestamp(cls, v):
@@ -45,4 +53,22 @@ class Event(BaseModel):
         }
 
     def dict(self, *args, **kwargs):
-        return self.model_dump(*args, **kwargs)
\ No newline at end of file
+        return self.model_dump(*args, **kwargs)
+
+class BatchRowResult(BaseModel):
+    index: int
+    status: str
+    id: Optional[int] = None
+    error: Optional[str] = None
+
+class BatchResponse(BaseModel):
+    accepted: int
+    rejected: int
+    results: List[BatchRowResult]
+
+class EventStats(BaseModel):
+    hotel_id: int
+    key: Optional[str] = None
+    count: int
+    ids: List[int] = []
+    room_ids: List[str] = []
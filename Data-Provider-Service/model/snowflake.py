@@ -0,0 +1,51 @@
+from dotenv import load_dotenv
+import os
+import socket
+import threading
+import time
+import zlib
+
+load_dotenv(override=True)
+
+# 2024-01-01T00:00:00Z; 41 bits of milliseconds after it last until 2093.
+EPOCH_MS = 1704067200000
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+MAX_NODE = (1 << NODE_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+def default_node():
+    # Every process that creates events needs its own node; set EVENT_ID_NODE
+    # explicitly when running several workers or replicas.
+    return zlib.crc32(f"{socket.gethostname()}:{os.getpid()}".encode()) & MAX_NODE
+
+class SnowflakeGenerator:
+    """64-bit ids of milliseconds since EPOCH_MS, node and a per-millisecond sequence.
+
+    Ids of one generator strictly increase. When the sequence of a
+    millisecond runs out, or the clock steps back, ids continue from the last
+    millisecond handed out instead of waiting for the clock.
+    """
+
+    def __init__(self, node, epoch_ms=EPOCH_MS):
+        if not 0 <= node <= MAX_NODE:
+            raise ValueError(f"Node must be between 0 and {MAX_NODE}")
+        self.node = node
+        self.epoch_ms = epoch_ms
+        self.last_ms = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def next_id(self):
+        with self.lock:
+            now_ms = max(int(time.time() * 1000) - self.epoch_ms, self.last_ms)
+            if now_ms == self.last_ms:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    now_ms += 1
+            else:
+                self.sequence = 0
+            self.last_ms = now_ms
+            return (now_ms << (NODE_BITS + SEQUENCE_BITS)) | (self.node << SEQUENCE_BITS) | self.sequence
+
+event_ids = SnowflakeGenerator(int(os.getenv("EVENT_ID_NODE", default_node())))
@@ -0,0 +1,63 @@
+from prometheus_client import Counter, Gauge, Histogram
+import time
+
+# Request latency per route template, so /events?after=... is one series.
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Latency of HTTP requests until the response starts",
+    ["method", "route", "status"]
+)
+
+MONGO_LATENCY = Histogram(
+    "mongodb_operation_duration_seconds",
+    "Latency of MongoDB operations",
+    ["operation"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+
+CONSUMER_MESSAGES = Counter(
+    "consumer_messages_total",
+    "Messages handled by the event consumer",
+    ["outcome"]
+)
+
+CONSUMER_BATCH_SIZES = Histogram(
+    "consumer_batch_size",
+    "Messages per batch handed to the consumer",
+    buckets=(1, 5, 10, 25, 50, 100, 200, 500, 1000)
+)
+
+CONSUMER_INSERT_RETRIES = Counter(
+    "consumer_insert_retries_total",
+    "Event inserts retried after a timeout"
+)
+
+BROKER_PUBLISH_LATENCY = Histogram(
+    "broker_publish_duration_seconds",
+    "Latency of publishing to RabbitMQ",
+    ["operation"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+
+# Refreshed on every scrape of /metrics.
+BROKER_QUEUE_MESSAGES = Gauge(
+    "broker_queue_messages",
+    "Events waiting in a partition queue for the consumer",
+    ["partition"]
+)
+
+async def track_request(request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # The router stores the matched route in the scope.
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(
+            request.method,
+            route.path if route is not None else "unmatched",
+            status
+        ).observe(time.perf_counter() - started)
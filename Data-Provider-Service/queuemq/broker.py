@@ -1,17 +1,75 @@
+import abc
 import asyncio
 import os
 import logging
 import json
+import zlib
 from aio_pika import connect_robust, Message, ExchangeType
 from dotenv import load_dotenv
 from urllib.parse import quote_plus
+from monitoring.metrics import BROKER_PUBLISH_LATENCY
 
 load_dotenv(override=True)
 
 # logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-class RabbitMQBroker:
+# amqp: RabbitMQ. memory: a bounded in-process queue, for a single process
+# running both the API and the consumer, and for tests and benchmarks.
+BROKER_BACKEND = os.getenv("BROKER_BACKEND", "amqp")
+BROKER_MEMORY_QUEUE_SIZE = int(os.getenv("BROKER_MEMORY_QUEUE_SIZE", 10000))
+# Events are routed to one of CONSUMER_PARTITIONS queues by hotel_id. Keep it
+# fixed once deployed: it decides which queue a hotel's events go to, while
+# the number of consumer workers can change freely.
+CONSUMER_PARTITIONS = int(os.getenv("CONSUMER_PARTITIONS", 1))
+
+def partition_of(key, partitions=CONSUMER_PARTITIONS):
+    # crc32 rather than hash(), which is salted per process.
+    if key is None or partitions <= 1:
+        return 0
+    return zlib.crc32(str(key).encode()) % partitions
+
+class Broker(abc.ABC):
+    """What the API and the consumer need from a message broker.
+
+    Messages are JSON strings. Consumers get their bodies as bytes, and a
+    message whose callback fails is redelivered or dropped as the backend
+    allows.
+    """
+
+    partitions = 1
+
+    async def connect(self):
+        pass
+
+    @abc.abstractmethod
+    async def publish(self, message: str, correlation_id: str = None, partition_key=None):
+        ...
+
+    @abc.abstractmethod
+    async def publish_batch(self, messages, pipeline_size=100):
+        ...
+
+    @abc.abstractmethod
+    async def publish_events(self, events):
+        ...
+
+    @abc.abstractmethod
+    async def consume(self, callback, partition=0):
+        ...
+
+    @abc.abstractmethod
+    async def consume_batch(self, callback, max_batch_size, max_linger, partition=0):
+        ...
+
+    async def backlog(self):
+        """Messages waiting per partition, for the queue lag metric."""
+        return {}
+
+    async def close(self):
+        pass
+
+class RabbitMQBroker(Broker):
     def __init__(self):
         self.host = os.getenv("RABBITMQ_HOST")
         self.user = os.getenv("RABBITMQ_USER")
@@ -20,10 +78,20 @@ class RabbitMQBroker:
         self.exchange_name = os.getenv("RABBITMQ_EXCHANGE")
         self.routing_key = os.getenv("RABBITMQ_ROUTING_KEY")
         self.queue_name = os.getenv("RABBITMQ_QUEUE")
+        self.events_exchange_name = os.getenv("RABBITMQ_EVENTS_EXCHANGE", "blankon_events")
+        self.prefetch_count = int(os.getenv("RABBITMQ_PREFETCH_COUNT", 500))
+        self.partitions = max(CONSUMER_PARTITIONS, 1)
+        self.publish_channels = int(os.getenv("RABBITMQ_PUBLISH_CHANNELS", 8))
+        self.confirm_timeout = int(os.getenv("RABBITMQ_CONFIRM_TIMEOUT_MS", 5000)) / 1000
         self.connection = None
         self.channel = None
         self.exchange = None
+        self.events_exchange = None
         self.queue = None
+        self.queues = {}
+        # (exchange, events_exchange) pairs, one per confirm-mode publish channel.
+        self.publishers = []
+        self.next_publisher = 0
 
         encoded_user = quote_plus(self.user)
         encoded_pass = quote_plus(self.password)
@@ -31,6 +99,28 @@ class RabbitMQBroker:
 
         # logger.debug(f"RabbitMQ URL: amqp://{encoded_user}:******@{self.host}:{self.port}/")
 
+    def partition_name(self, name, partition):
+        """Queue name or routing key of a partition; a single partition keeps the plain name."""
+        return name if self.partitions == 1 else f"{name}.{partition}"
+
+    @property
+    def queue_arguments(self):
+        # Only one consumer of a partition queue gets messages at a time, so a
+        # hotel's events stay in order even while two workers overlap.
+        return {"x-single-active-consumer": True} if self.partitions > 1 else None
+
+    async def declare_partitions(self, channel, exchange):
+        queues = {}
+        for partition in range(self.partitions):
+            queue = await channel.declare_queue(
+                self.partition_name(self.queue_name, partition),
+                durable=True,
+                arguments=self.queue_arguments
+            )
+            await queue.bind(exchange, routing_key=self.partition_name(self.routing_key, partition))
+            queues[partition] = queue
+        return queues
+
     async def connect(self):
         max_retries = 10
         retry_delay = 5
@@ -47,9 +137,28 @@ class RabbitMQBroker:
                     durable=True
                 )
                 
-                self.queue = await self.channel.declare_queue(self.queue_name, durable=True)
-                await self.queue.bind(self.exchange, routing_key=self.routing_key)
-                
+                self.queues = await self.declare_partitions(self.channel, self.exchange)
+                self.queue = self.queues[0]
+
+                # Stored events are fanned out here; subscribers bind their own queues.
+                self.events_exchange = await self.channel.declare_exchange(
+                    self.events_exchange_name,
+                    ExchangeType.TOPIC,
+                    durable=True
+                )
+
+                # Publishes are spread over a pool of confirm-mode channels, so
+                # concurrent requests do not queue behind one channel's writes.
+                # Returned (unroutable) messages fail the publish instead of
+                # being confirmed.
+                self.publishers = []
+                for _ in range(max(self.publish_channels, 1)):
+                    channel = await self.connection.channel(publisher_confirms=True, on_return_raises=True)
+                    self.publishers.append((
+                        await channel.get_exchange(self.exchange_name, ensure=False),
+                        await channel.get_exchange(self.events_exchange_name, ensure=False)
+                    ))
+
                 logger.info(f"Successfully connected to RabbitMQ at {self.host}:{self.port}")
                 break
             except Exception as e:
@@ -61,32 +170,267 @@ class RabbitMQBroker:
                     logger.error(f"Max retries reached. Unable to connect to RabbitMQ. Error: {e}", exc_info=True)
                     raise
 
-    async def publish(self, message: str, correlation_id: str = None):
-        if not self.connection or self.connection.is_closed:
-            await self.connect()
-        
-        await self.exchange.publish(
+    def _publisher(self):
+        publisher = self.publishers[self.next_publisher % len(self.publishers)]
+        self.next_publisher += 1
+        return publisher
+
+    def _publish(self, publisher, message: str, correlation_id: str = None, partition=0):
+        exchange, _ = publisher
+        return exchange.publish(
             Message(
                 body=message.encode(),
                 correlation_id=correlation_id,
                 delivery_mode=2
             ),
-            routing_key=self.routing_key
+            routing_key=self.partition_name(self.routing_key, partition),
+            timeout=self.confirm_timeout
         )
-        logger.info(f"Sent message to {self.routing_key} with correlation_id: {correlation_id}")
 
-    async def consume(self, callback):
+    async def publish(self, message: str, correlation_id: str = None, partition_key=None):
+        """Publish one persistent message and wait for the broker to confirm it.
+
+        `partition_key` (the hotel_id) picks the partition queue. The robust
+        connection reconnects and reopens the pool by itself, so only the
+        first publish connects.
+        """
+        if not self.publishers:
+            await self.connect()
+
+        partition = partition_of(partition_key, self.partitions)
+        with BROKER_PUBLISH_LATENCY.labels("publish").time():
+            await self._publish(self._publisher(), message, correlation_id, partition)
+        logger.info(f"Sent message to {self.partition_name(self.routing_key, partition)} with correlation_id: {correlation_id}")
+
+    async def publish_batch(self, messages, pipeline_size=100):
+        """Publish (message, correlation_id, partition_key) tuples, keeping up to `pipeline_size` publishes in flight.
+
+        Each chunk is written across the channel pool without waiting in
+        between, then its confirms are awaited together. Messages of one
+        partition go through the same channel, so they reach their queue in
+        order. Returns one entry per message: None when the broker confirmed
+        it, otherwise the exception.
+        """
+        if not self.publishers:
+            await self.connect()
+
+        offset = self.next_publisher
+        self.next_publisher += 1
+        results = []
+        for start in range(0, len(messages), pipeline_size):
+            chunk = messages[start:start + pipeline_size]
+            with BROKER_PUBLISH_LATENCY.labels("publish_batch").time():
+                publishes = []
+                for message, correlation_id, partition_key in chunk:
+                    partition = partition_of(partition_key, self.partitions)
+                    publisher = self.publishers[(offset + partition) % len(self.publishers)]
+                    publishes.append(self._publish(publisher, message, correlation_id, partition))
+                outcomes = await asyncio.gather(*publishes, return_exceptions=True)
+            results.extend(outcome if isinstance(outcome, Exception) else None for outcome in outcomes)
+        logger.info(f"Sent batch of {len(messages)} messages to {self.exchange_name}")
+        return results
+
+    async def publish_events(self, events):
+        """Fan stored events out on the events exchange as event.<booked|cancelled>.<hotel_id>."""
+        if not self.publishers:
+            await self.connect()
+
+        # One channel for the whole call keeps the events in the order they were stored.
+        _, events_exchange = self._publisher()
+        with BROKER_PUBLISH_LATENCY.labels("publish_events").time():
+            await asyncio.gather(*[
+                events_exchange.publish(
+                    Message(
+                        body=event.model_dump_json().encode(),
+                        correlation_id=str(event.id),
+                        content_type="application/json",
+                        delivery_mode=2
+                    ),
+                    routing_key=f"event.{'booked' if event.rpg_status == 1 else 'cancelled'}.{event.hotel_id}",
+                    # Nobody may be subscribed yet, so an unrouted event is not an error.
+                    mandatory=False,
+                    timeout=self.confirm_timeout
+                )
+                for event in events
+            ])
+        logger.info(f"Fanned out {len(events)} events to {self.events_exchange_name}")
+
+    async def consumer_channel(self, partition):
+        """A channel of its own for consuming one partition queue.
+
+        Delivery tags and the prefetch limit are per channel, so a
+        multiple-ack only ever settles messages of this partition and every
+        partition gets `prefetch_count` messages.
+        """
+        channel = await self.connection.channel()
+        await channel.set_qos(prefetch_count=self.prefetch_count)
+        queue = await channel.get_queue(self.partition_name(self.queue_name, partition), ensure=False)
+        return channel, queue
+
+    async def consume(self, callback, partition=0):
+        if not self.connection or self.connection.is_closed:
+            await self.connect()
+
+        channel, queue = await self.consumer_channel(partition)
+        try:
+            async with queue.iterator() as queue_iter:
+                async for message in queue_iter:
+                    async with message.process():
+                        await callback(message.body)
+        finally:
+            await channel.close()
+
+    async def consume_batch(self, callback, max_batch_size, max_linger, partition=0):
+        """Deliver messages of one partition queue to `callback` in batches of up to `max_batch_size` bodies.
+
+        A batch is handed over once it is full or `max_linger` seconds after its
+        first message arrived. The callback returns the indexes of messages that
+        must be rejected; everything else in the batch is acked. If the callback
+        raises, the whole batch is requeued and the error is propagated.
+        """
         if not self.connection or self.connection.is_closed:
             await self.connect()
 
-        async with self.queue.iterator() as queue_iter:
-            async for message in queue_iter:
-                async with message.process():
-                    await callback(message.body)
+        channel, queue = await self.consumer_channel(partition)
+        pending = asyncio.Queue()
+        consumer_tag = await queue.consume(pending.put)
+        loop = asyncio.get_running_loop()
+
+        try:
+            while True:
+                batch = [await pending.get()]
+                deadline = loop.time() + max_linger
+                while len(batch) < max_batch_size:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(pending.get(), timeout=remaining))
+                    except asyncio.TimeoutError:
+                        break
+
+                try:
+                    rejected = await callback([message.body for message in batch])
+                except Exception:
+                    for message in batch:
+                        await message.nack(requeue=True)
+                    raise
+
+                await self._settle_batch(batch, rejected)
+        finally:
+            await queue.cancel(consumer_tag)
+            # Hand back prefetched messages that never made it into a batch.
+            while not pending.empty():
+                await pending.get_nowait().nack(requeue=True)
+            await channel.close()
+
+    async def _settle_batch(self, batch, rejected):
+        if not rejected:
+            # Everything up to the last delivery tag of this partition's
+            # channel has been handled, so one multiple-ack settles the batch.
+            await batch[-1].ack(multiple=True)
+            return
+
+        for index, message in enumerate(batch):
+            if index in rejected:
+                await message.nack(requeue=False)
+            else:
+                await message.ack()
+        logger.warning(f"Rejected {len(rejected)} of {len(batch)} messages in batch")
+
+    async def backlog(self):
+        if not self.connection or self.connection.is_closed:
+            return {}
+        # A passive declare only reads the queue's counters. It gets its own
+        # channel, since a failed declare closes the channel it ran on.
+        backlog = {}
+        async with self.connection.channel() as channel:
+            for partition in range(self.partitions):
+                queue = await channel.declare_queue(self.partition_name(self.queue_name, partition), passive=True)
+                backlog[partition] = queue.declaration_result.message_count
+        return backlog
 
     async def close(self):
+        self.publishers = []
         if self.connection and not self.connection.is_closed:
             await self.connection.close()
             logger.info("RabbitMQ connection closed")
 
-rabbitmq_broker = RabbitMQBroker()
\ No newline at end of file
+class InMemoryBroker(Broker):
+    """Hands messages from publishers to the consumer of the same process.
+
+    Messages are routed to one queue per partition by their partition key,
+    as RabbitMQBroker does. Each queue is bounded, so publishers wait once
+    the consumer of a partition falls `max_size` messages behind. Nothing
+    survives a restart, and stored events are not fanned out to other
+    services; the dashboard picks them up with its checkpoint poll.
+    """
+
+    def __init__(self, max_size=BROKER_MEMORY_QUEUE_SIZE, partitions=CONSUMER_PARTITIONS):
+        self.partitions = max(partitions, 1)
+        self.queues = {partition: asyncio.Queue(maxsize=max_size) for partition in range(self.partitions)}
+        # Messages of a failed batch, delivered again before the queue.
+        self.redelivered = {partition: [] for partition in range(self.partitions)}
+
+    async def publish(self, message: str, correlation_id: str = None, partition_key=None):
+        await self.queues[partition_of(partition_key, self.partitions)].put(message.encode())
+
+    async def publish_batch(self, messages, pipeline_size=100):
+        for message, _, partition_key in messages:
+            await self.queues[partition_of(partition_key, self.partitions)].put(message.encode())
+        return [None] * len(messages)
+
+    async def publish_events(self, events):
+        pass
+
+    async def next_message(self, partition=0, timeout=None):
+        if self.redelivered[partition]:
+            return self.redelivered[partition].pop(0)
+        if timeout is None:
+            return await self.queues[partition].get()
+        return await asyncio.wait_for(self.queues[partition].get(), timeout=timeout)
+
+    async def backlog(self):
+        return {partition: queue.qsize() + len(self.redelivered[partition]) for partition, queue in self.queues.items()}
+
+    async def consume(self, callback, partition=0):
+        while True:
+            body = await self.next_message(partition)
+            try:
+                await callback(body)
+            except Exception as e:
+                # Same as a rejected AMQP message without a dead letter queue.
+                logger.error(f"Dropping message after failed callback: {str(e)}")
+
+    async def consume_batch(self, callback, max_batch_size, max_linger, partition=0):
+        """Same batching as RabbitMQBroker.consume_batch; rejected messages are dropped."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.next_message(partition)]
+            deadline = loop.time() + max_linger
+            while len(batch) < max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await self.next_message(partition, timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                rejected = await callback(batch)
+            except Exception:
+                self.redelivered[partition] = batch + self.redelivered[partition]
+                raise
+
+            if rejected:
+                logger.warning(f"Rejected {len(rejected)} of {len(batch)} messages in batch")
+
+def create_broker():
+    if BROKER_BACKEND == "memory":
+        return InMemoryBroker()
+    if BROKER_BACKEND == "amqp":
+        return RabbitMQBroker()
+    raise ValueError(f"Unknown BROKER_BACKEND {BROKER_BACKEND}, must be amqp or memory")
+
+broker = create_broker()
\ No newline at end of file
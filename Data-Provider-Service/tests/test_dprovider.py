@@ -3,14 +3,23 @@ import sys
 import os
 import random
 import asyncio
+import json
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from httpx import AsyncClient, ASGITransport
 from datetime import datetime, timedelta
-from dataprovider import app
+from dataprovider import app, setup_mongodb
 from model.data_provider_model import Event
-from queuemq.broker import rabbitmq_broker
-from database.mongodb import connect_to_mongo, close_mongo_connection
+from queuemq.broker import broker, InMemoryBroker, partition_of
+from event.provider_consumer import batch_callback, worker_partitions
+from model.snowflake import SnowflakeGenerator
+from database.mongodb import bump_events_version, connect_to_mongo, close_mongo_connection, db
+from database.event_schema import field
+from api import dprovider
+from api.dprovider import build_event_query, merge_stats_groups
+from api.pagination import EVENT_SORT, apply_cursor, encode_cursor
+from mongo_indexes import collection_scans
+from bson import ObjectId
 from datetime import date, timezone
 
 
@@ -24,10 +33,10 @@ async def client():
 
 @pytest.fixture(scope="module", autouse=True)
 async def setup_teardown():
-    connect_to_mongo()
-    await rabbitmq_broker.connect()
+    await connect_to_mongo()
+    await broker.connect()
     yield
-    await rabbitmq_broker.close()
+    await broker.close()
     close_mongo_connection()
 
 @pytest.fixture
@@ -177,5 +186,285 @@ async def test_get_events_with_all_parameters(client):
         )
         assert is_sorted_by_timestamp(events)
 
+@pytest.mark.asyncio
+async def test_get_events_cursor_pagination(client):
+    async for c in client:
+        seen_ids = []
+        params = {"hotel_id": 1, "limit": 5}
+        for _ in range(3):
+            response = await c.get("/events", params=params)
+            assert response.status_code == 200
+            events = response.json()
+            assert len(events) <= 5
+            assert is_sorted_by_timestamp(events)
+            seen_ids.extend(event["id"] for event in events)
+            if len(events) < 5:
+                break
+            params["after"] = response.headers["X-Next-Cursor"]
+        assert len(seen_ids) == len(set(seen_ids))
+
+@pytest.mark.asyncio
+async def test_get_events_invalid_cursor(client):
+    async for c in client:
+        response = await c.get("/events", params={"after": "not-a-cursor"})
+        assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_get_events_ingest_order_pagination(client):
+    async for c in client:
+        timestamp_page = await c.get("/events", params={"limit": 5})
+        seen_ids = []
+        params = {"order": "ingest", "limit": 5}
+        for _ in range(3):
+            response = await c.get("/events", params=params)
+            assert response.status_code == 200
+            events = response.json()
+            seen_ids.extend(event["id"] for event in events)
+            if len(events) < 5:
+                break
+            params["after"] = response.headers["X-Next-Cursor"]
+        assert len(seen_ids) == len(set(seen_ids))
+        if "X-Next-Cursor" in timestamp_page.headers:
+            response = await c.get("/events", params={"order": "ingest", "after": timestamp_page.headers["X-Next-Cursor"]})
+            assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_get_events_ndjson_stream(client):
+    async for c in client:
+        response = await c.get("/events", params={"hotel_id": 1, "format": "ndjson"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        events = [json.loads(line) for line in response.text.splitlines() if line]
+        assert all(event["hotel_id"] == 1 for event in events)
+        assert is_sorted_by_timestamp(events)
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("format", ["json", "ndjson"])
+async def test_get_events_timestamps_are_utc(format, client):
+    async for c in client:
+        response = await c.get("/events", params={"hotel_id": 1, "limit": 20, "format": format})
+        assert response.status_code == 200
+        events = [json.loads(line) for line in response.text.splitlines() if line] if format == "ndjson" else response.json()
+        assert events
+        for event in events:
+            assert event["timestamp"].endswith("Z")
+            assert datetime.fromisoformat(event["timestamp"].replace("Z", "+00:00")).tzinfo == timezone.utc
+        break
+
+@pytest.mark.asyncio
+async def test_create_events_batch_json(sample_event, client):
+    async for c in client:
+        invalid_event = dict(sample_event, rpg_status=3)
+        response = await c.post("/events/batch", json=[sample_event, invalid_event, sample_event])
+        assert response.status_code == 200
+        body = response.json()
+        assert body["accepted"] == 2
+        assert body["rejected"] == 1
+        assert [result["status"] for result in body["results"]] == ["accepted", "rejected", "accepted"]
+
+@pytest.mark.asyncio
+async def test_create_events_batch_rejects_rows_over_limit(sample_event, client, monkeypatch):
+    monkeypatch.setattr(dprovider, "EVENTS_BATCH_MAX_ROWS", 2)
+    async for c in client:
+        response = await c.post("/events/batch", json=[sample_event] * 3)
+        assert response.status_code == 200
+        body = response.json()
+        assert body["accepted"] == 2
+        assert [result["status"] for result in body["results"]] == ["accepted", "accepted", "rejected"]
+
+@pytest.mark.asyncio
+async def test_create_events_batch_ndjson(sample_event, client):
+    async for c in client:
+        lines = [json.dumps(sample_event) for _ in range(10)] + ["not json"]
+        response = await c.post(
+            "/events/batch",
+            content="\n".join(lines),
+            headers={"Content-Type": "application/x-ndjson"}
+        )
+        assert response.status_code == 200
+        body = response.json()
+        assert body["accepted"] == 10
+        assert body["rejected"] == 1
+        assert body["results"][-1]["index"] == 10
+
+@pytest.mark.asyncio
+async def test_create_events_batch_not_a_list(sample_event, client):
+    async for c in client:
+        response = await c.post("/events/batch", json=sample_event)
+        assert response.status_code == 400
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("params", [
+    {"rpg_status": 1, "updated__gte": datetime(2024, 1, 1), "updated__lte": datetime(2024, 12, 31, 23, 59, 59)},
+    {"hotel_id": 1, "rpg_status": 1},
+    {"hotel_id": 1, "updated__gte": datetime(2024, 1, 1)},
+    {"hotel_id": 1, "night_of_stay__gte": date(2024, 1, 1), "night_of_stay__lte": date(2024, 1, 31)},
+    {"hotel_id": 1, "room_id": "101"},
+    {},
+])
+async def test_get_events_queries_use_indexes(params):
+    await setup_mongodb()
+    query = build_event_query(**params)
+    collection = db.db[os.getenv("MONGODB_COLLECTION")]
+    explain = await collection.find(query).sort(EVENT_SORT).explain()
+    assert not collection_scans(explain)
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("group_by", ["night", "month", "hotel"])
+async def test_get_event_stats_matches_events(group_by, client):
+    async for c in client:
+        params = {"hotel_id": 1, "rpg_status": 1}
+        events_response = await c.get("/events", params=params)
+        stats_response = await c.get("/events/stats", params=dict(params, group_by=group_by))
+        assert stats_response.status_code == 200
+        stats = stats_response.json()
+        assert all(row["hotel_id"] == 1 for row in stats)
+        assert sum(row["count"] for row in stats) == len(events_response.json())
+        assert sorted(event_id for row in stats for event_id in row["ids"]) == sorted(event["id"] for event in events_response.json())
+
+def test_stats_groups_merge_schema_versions_and_skip_null_ids():
+    groups = [
+        {"_id": {"hotel_id": 1, "key": date(2024, 1, 5).toordinal()}, "count": 2, "ids": [1, None], "room_ids": ["101", "102"]},
+        {"_id": {"hotel_id": 1, "key": "2024-01-05"}, "count": 1, "ids": [3], "room_ids": ["103"]},
+    ]
+    assert merge_stats_groups(groups, "night") == [((1, "2024-01-05"), {"count": 3, "ids": [1, 3], "room_ids": ["101", "103"]})]
+
+@pytest.mark.asyncio
+async def test_get_event_stats_invalid_group_by(client):
+    async for c in client:
+        response = await c.get("/events/stats", params={"group_by": "week"})
+        assert response.status_code == 400
+
+def test_event_query_matches_unmigrated_documents():
+    query = build_event_query(hotel_id=1, updated__gte=datetime(2024, 1, 1, tzinfo=timezone.utc), night_of_stay__lte=date(2024, 1, 31), legacy=True)
+    assert query["$or"][1] == {
+        "hotel_id": 1,
+        "timestamp": {"$gte": "2024-01-01T00:00:00"},
+        "night_of_stay": {"$lte": "2024-01-31"}
+    }
+    # Equality filters match both versions alike under the long field names.
+    if field("hotel_id") == "hotel_id":
+        assert build_event_query(hotel_id=1, legacy=True) == {"hotel_id": 1}
+
+def test_cursor_after_unmigrated_document_reaches_migrated_ones():
+    document = {"_id": ObjectId(), field("timestamp"): "2024-01-01T10:00:00"}
+    after = apply_cursor({}, encode_cursor(document))
+    assert {field("timestamp"): {"$type": "date"}} in after["$or"]
+
+@pytest.mark.asyncio
+async def test_get_events_not_modified(client):
+    async for c in client:
+        params = {"hotel_id": 1, "limit": 10}
+        response = await c.get("/events", params=params)
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+        assert "Last-Modified" in response.headers
+
+        response = await c.get("/events", params=params, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        assert response.content == b""
+
+        response = await c.get("/events", params=dict(params, limit=5), headers={"If-None-Match": etag})
+        assert response.status_code == 200
+
+        # Last-Modified has second resolution, so only the ETag revalidates.
+        response = await c.get("/events", params=params, headers={"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"})
+        assert response.status_code == 200
+
+@pytest.mark.asyncio
+async def test_get_events_etag_changes_after_rewrite(client):
+    async for c in client:
+        params = {"hotel_id": 1, "limit": 5}
+        etag = (await c.get("/events", params=params)).headers["ETag"]
+        # As after migrate_events.py --dedupe-ids, which changes stored ids in place.
+        await bump_events_version()
+        response = await c.get("/events", params=params, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        break
+
+@pytest.mark.asyncio
+async def test_in_memory_broker_redelivers_failed_batch():
+    memory_broker = InMemoryBroker(max_size=10)
+    await memory_broker.publish_batch([(json.dumps({"n": i}), str(i), None) for i in range(3)])
+    batches = []
+
+    async def callback(batch):
+        batches.append(batch)
+        if len(batches) == 1:
+            raise RuntimeError("insert failed")
+        raise asyncio.CancelledError
+
+    with pytest.raises(RuntimeError):
+        await memory_broker.consume_batch(callback, 10, 0.01)
+    with pytest.raises(asyncio.CancelledError):
+        await memory_broker.consume_batch(callback, 10, 0.01)
+    assert batches[0] == batches[1] == [json.dumps({"n": i}).encode() for i in range(3)]
+
+@pytest.mark.asyncio
+async def test_in_memory_broker_routes_by_partition():
+    memory_broker = InMemoryBroker(max_size=100, partitions=4)
+    hotel_ids = list(range(1, 21))
+    await memory_broker.publish_batch([(json.dumps({"hotel_id": hotel_id}), None, hotel_id) for hotel_id in hotel_ids[:10]])
+    for hotel_id in hotel_ids[10:]:
+        await memory_broker.publish(json.dumps({"hotel_id": hotel_id}), partition_key=hotel_id)
+    backlog = await memory_broker.backlog()
+    assert sum(backlog.values()) == len(hotel_ids)
+
+    for partition in worker_partitions(4, workers=2, index=1):
+        batches = []
+
+        async def callback(batch):
+            batches.append(batch)
+            raise asyncio.CancelledError
+
+        with pytest.raises(asyncio.CancelledError):
+            await memory_broker.consume_batch(callback, 100, 0.01, partition)
+        assert [json.loads(body)["hotel_id"] for body in batches[0]] == [
+            hotel_id for hotel_id in hotel_ids if partition_of(hotel_id, 4) == partition
+        ]
+        assert (await memory_broker.backlog())[partition] == 0
+
+def test_snowflake_ids_increase():
+    generator = SnowflakeGenerator(node=5)
+    ids = [generator.next_id() for _ in range(20000)]
+    assert all(earlier < later for earlier, later in zip(ids, ids[1:]))
+    assert {(event_id >> 12) & 1023 for event_id in ids} == {5}
+
+@pytest.mark.asyncio
+async def test_redelivered_batch_is_stored_once(sample_event):
+    message = json.dumps(Event(**sample_event).dict(), default=str).encode()
+    event_id = json.loads(message)["id"]
+    assert await batch_callback([message, message]) == set()
+    assert await batch_callback([message]) == set()
+    collection = db.db[os.getenv("MONGODB_COLLECTION")]
+    assert await collection.count_documents({field("id"): event_id}) == 1
+
+@pytest.mark.asyncio
+async def test_null_ids_are_stored_as_separate_events(sample_event):
+    messages = [json.dumps(dict(sample_event, id=None, room_id=room_id)).encode() for room_id in ("901", "902")]
+    collection = db.db[os.getenv("MONGODB_COLLECTION")]
+    query = {field("hotel_id"): sample_event["hotel_id"], field("room_id"): {"$in": ["901", "902"]}}
+    stored = await collection.count_documents(query)
+    assert await batch_callback(messages) == set()
+    assert await collection.count_documents(query) == stored + 2
+
+@pytest.mark.asyncio
+async def test_publish_batch_is_confirmed(sample_event):
+    messages = [(json.dumps(Event(**sample_event).dict(), default=str), str(i), sample_event["hotel_id"]) for i in range(50)]
+    outcomes = await asyncio.gather(
+        broker.publish_batch(messages[:25], pipeline_size=10),
+        *[broker.publish(*message) for message in messages[25:]]
+    )
+    assert outcomes[0] == [None] * 25
+    assert outcomes[1:] == [None] * 25
+
+def test_worker_partitions_cover_every_partition_once():
+    owned = [worker_partitions(16, workers=3, index=index) for index in range(3)]
+    assert sorted(sum(owned, [])) == list(range(16))
+    assert partition_of(7, 16) == partition_of("7", 16)
+    assert partition_of(7, 1) == 0
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v", "-s"])
\ No newline at end of file
@@ -1,9 +1,13 @@
+import argparse
 import csv
 import random
 import asyncio
 import aiohttp
 import os
 import logging
+import statistics
+import time
+from collections import Counter
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
@@ -85,9 +89,107 @@ async def simulate_orders(csv_data):
             print(f"Waiting for {wait_time} seconds before next simulation...")
             await asyncio.sleep(wait_time)
 
+def load_schedule(csv_data, rps, replay_speed):
+    """Yield (offset in seconds, order) pairs for the load generator.
+
+    With a replay speed the CSV is sent in event_timestamp order, with the
+    gaps between events divided by the speed. Otherwise orders are spaced
+    evenly at `rps` and the CSV is sent over and over; every further pass
+    shifts the ids so the orders are new events.
+    """
+    if replay_speed:
+        rows = sorted(csv_data, key=lambda row: row['event_timestamp'])
+        start = datetime.strptime(rows[0]['event_timestamp'], '%Y-%m-%d %H:%M:%S')
+        for row in rows:
+            offset = (datetime.strptime(row['event_timestamp'], '%Y-%m-%d %H:%M:%S') - start).total_seconds()
+            yield offset / replay_speed, map_csv_to_post_data(row)
+        return
+
+    id_stride = max(int(row['id']) for row in csv_data) + 1
+    sent = 0
+    while True:
+        for row in csv_data:
+            order = map_csv_to_post_data(row)
+            order["id"] += (sent // len(csv_data)) * id_stride
+            yield sent / rps, order
+            sent += 1
+
+async def send_load_order(session, order, latencies, statuses):
+    # No retries and no logging per order: both would distort the latencies.
+    started = time.perf_counter()
+    try:
+        async with session.post(DATA_PROVIDER_URL, json=order) as response:
+            await response.read()
+            statuses[response.status] += 1
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        statuses[type(e).__name__] += 1
+        return
+    latencies.append(time.perf_counter() - started)
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+async def generate_load(csv_data, rps, concurrency, duration, replay_speed):
+    """Send orders on a fixed schedule and report throughput and latency.
+
+    At most `concurrency` requests are in flight. Once they are all busy the
+    schedule falls behind, so an achieved rate below the target marks the
+    saturation point of POST /events.
+    """
+    latencies = []
+    statuses = Counter()
+    slots = asyncio.Semaphore(concurrency)
+    tasks = set()
+
+    async def send(session, order):
+        try:
+            await send_load_order(session, order, latencies, statuses)
+        finally:
+            slots.release()
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        started = time.perf_counter()
+        for offset, order in load_schedule(csv_data, rps, replay_speed):
+            if offset >= duration:
+                break
+            delay = started + offset - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await slots.acquire()
+            task = asyncio.create_task(send(session, order))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+    sent = sum(statuses.values())
+    print(f"Sent {sent} orders in {elapsed:.1f}s: {sent / elapsed:.1f} orders/s" + (f" (target {rps}/s)" if not replay_speed else f" ({replay_speed}x replay)"))
+    print("Responses: " + ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items(), key=str)))
+    if latencies:
+        latencies.sort()
+        print(
+            f"Latency ms: p50 {percentile(latencies, 0.50) * 1000:.1f}, p95 {percentile(latencies, 0.95) * 1000:.1f}, "
+            f"p99 {percentile(latencies, 0.99) * 1000:.1f}, max {latencies[-1] * 1000:.1f}, mean {statistics.mean(latencies) * 1000:.1f}"
+        )
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Simulate hotel orders, or load test POST /events.")
+    parser.add_argument("--load", action="store_true", help="Send orders as fast as the options below allow instead of 1-3 every minute")
+    parser.add_argument("--rps", type=float, default=100, help="Target orders per second")
+    parser.add_argument("--concurrency", type=int, default=50, help="Maximum requests in flight")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to send orders for")
+    parser.add_argument("--replay-speed", type=float, default=None, help="Replay data.csv in timestamp order at this many times the original speed instead of --rps")
+    return parser.parse_args()
+
 async def main():
+    args = parse_args()
     csv_data = await read_csv_data()
-    await simulate_orders(csv_data)
+    if args.load:
+        logging.getLogger().setLevel(logging.WARNING)
+        await generate_load(csv_data, args.rps, args.concurrency, args.duration, args.replay_speed)
+    else:
+        await simulate_orders(csv_data)
 
 if __name__ == "__main__":
     logging.info("Hotel order simulation process starting...")
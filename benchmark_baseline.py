@@ -0,0 +1,58 @@
+"""Baselines of the offline benchmarks, shared by both services.
+
+The benchmarks run against mongomock_motor and an in-process broker, so
+their results are smoke numbers: they catch regressions in the services'
+own code between runs on the same machine, and say nothing about the
+throughput or latency of a deployment against MongoDB and RabbitMQ.
+"""
+import json
+import os
+import platform
+import sys
+from datetime import datetime
+
+def higher_is_better(name):
+    # Rates end in _per_s, everything else is a duration.
+    return name.endswith("_per_s")
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_baseline(path, results, options):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({
+            "kind": "smoke",
+            "recorded_at": datetime.utcnow().replace(microsecond=0).isoformat(),
+            "python": sys.version.split()[0],
+            "machine": platform.machine(),
+            "options": options,
+            "results": {metric: round(value, 3) for metric, value in results.items()}
+        }, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print(f"Saved baseline to {path}")
+
+def report(path, results, tolerance, options):
+    """Print every result next to its baseline and return the names that regressed by more than `tolerance`."""
+    recorded = load_baseline(path) or {}
+    baseline = recorded.get("results", {})
+    if recorded.get("options", options) != options:
+        print(f"The baseline was recorded with {recorded['options']}, the numbers are not comparable")
+    regressions = []
+    print("Smoke numbers against mongomock_motor and an in-process broker, not deployment throughput")
+    print(f"{'metric':<40} {'value':>12} {'baseline':>12} {'change':>8}")
+    for metric, value in results.items():
+        previous = baseline.get(metric)
+        if not previous:
+            print(f"{metric:<40} {value:>12.3f} {'-':>12} {'-':>8}")
+            continue
+        change = (value - previous) / previous
+        worse = -change if higher_is_better(metric) else change
+        flag = " !" if worse > tolerance else ""
+        if flag:
+            regressions.append(metric)
+        print(f"{metric:<40} {value:>12.3f} {previous:>12.3f} {change:>+7.0%}{flag}")
+    return regressions
@@ -0,0 +1,174 @@
+"""Index definitions shared by rpgprep.py and both services.
+
+Each collection has a list of index specs. `plan_indexes` compares a spec with
+what `index_information()` reports and returns what has to be created and
+dropped, so the same spec can be applied with PyMongo (rpgprep) or Motor
+(the services).
+"""
+import re
+from datetime import date, datetime
+from pymongo import IndexModel
+
+# Compound indexes follow equality -> sort -> range order for the filters
+# GET /events actually sends. _id is the keyset tie-breaker of the events
+# cursor, so it closes every index the paginated scan walks.
+EVENT_INDEXES = [
+    {"name": "hotel_id_rpg_status_timestamp", "keys": [("hotel_id", 1), ("rpg_status", 1), ("timestamp", 1), ("_id", 1)]},
+    {"name": "hotel_id_timestamp", "keys": [("hotel_id", 1), ("timestamp", 1), ("_id", 1)]},
+    {"name": "rpg_status_timestamp", "keys": [("rpg_status", 1), ("timestamp", 1), ("_id", 1)]},
+    {"name": "timestamp", "keys": [("timestamp", 1), ("_id", 1)]},
+    {"name": "hotel_id_night_of_stay", "keys": [("hotel_id", 1), ("night_of_stay", 1)]},
+    {"name": "hotel_id_room_id", "keys": [("hotel_id", 1), ("room_id", 1)]},
+    # The consumer upserts on id, so a redelivered event is stored once.
+    {"name": "id", "keys": [("id", 1)], "unique": True},
+]
+
+# Indexes earlier releases created. Only these and the indexes of a spec are
+# dropped automatically; any other index was added by an operator and is kept.
+RETIRED_EVENT_INDEXES = ["hotel_id_1", "timestamp_1", "rpg_status_1", "room_id_1", "night_of_stay_1"]
+
+# Short field names used when the events collection stores compact documents
+# (EVENTS_COMPACT_FIELDS=true). Specs and query shapes use the long names.
+EVENT_COMPACT_FIELDS = {
+    "id": "i",
+    "hotel_id": "h",
+    "timestamp": "t",
+    "rpg_status": "s",
+    "room_id": "r",
+    "night_of_stay": "n",
+    "schema_version": "v",
+}
+
+# Daily documents are only written by the grabber; GET /dashboard reads the
+# materialized per-hotel-year documents of DASHBOARD_VIEW_INDEXES.
+DASHBOARD_INDEXES = [
+    {"name": "hotel_id_date_type", "keys": [("hotel_id", 1), ("date", 1), ("type", 1)], "unique": True},
+    {"name": "year", "keys": [("year", 1)]},
+]
+
+RETIRED_DASHBOARD_INDEXES = ["hotel_id_1", "year_1", "date_1", "type_1", "hotel_id_year_type_date"]
+
+DASHBOARD_VIEW_INDEXES = [
+    {"name": "hotel_id_year", "keys": [("hotel_id", 1), ("year", 1)], "unique": True},
+    {"name": "year", "keys": [("year", 1)]},
+]
+
+# Representative filters of the hot read paths, used by the explain() check.
+EVENT_QUERY_SHAPES = [
+    {"name": "grabber window", "filter": {"rpg_status": 1, "timestamp": {"$gte": datetime(2024, 1, 1), "$lte": datetime(2024, 12, 31, 23, 59, 59)}}, "sort": [("timestamp", 1), ("_id", 1)]},
+    {"name": "hotel window", "filter": {"hotel_id": 1, "rpg_status": 1, "timestamp": {"$gte": datetime(2024, 1, 1)}}, "sort": [("timestamp", 1), ("_id", 1)]},
+    {"name": "hotel events", "filter": {"hotel_id": 1}, "sort": [("timestamp", 1), ("_id", 1)]},
+    {"name": "hotel nights", "filter": {"hotel_id": 1, "night_of_stay": {"$gte": date(2024, 1, 1).toordinal(), "$lte": date(2024, 1, 31).toordinal()}}, "sort": [("timestamp", 1), ("_id", 1)]},
+    {"name": "hotel room", "filter": {"hotel_id": 1, "room_id": "101"}, "sort": [("timestamp", 1), ("_id", 1)]},
+    {"name": "all events", "filter": {}, "sort": [("timestamp", 1), ("_id", 1)]},
+]
+
+DASHBOARD_QUERY_SHAPES = [
+    {"name": "daily merge", "filter": {"hotel_id": 1, "date": "2024-02-01", "type": "daily"}, "sort": []},
+]
+
+DASHBOARD_VIEW_QUERY_SHAPES = [
+    {"name": "dashboard year", "filter": {"hotel_id": 1, "year": 2024}, "sort": []},
+    {"name": "portfolio", "filter": {"hotel_id": {"$in": [1, 2, 3]}, "year": {"$gte": 2023, "$lte": 2024}}, "sort": [("hotel_id", 1), ("year", 1)]},
+]
+
+def rename_index_fields(spec, field_names):
+    """Return a copy of `spec` with key fields renamed through `field_names`."""
+    return [
+        dict(index, keys=[(field_names.get(field, field), direction) for field, direction in index["keys"]])
+        for index in spec
+    ]
+
+def rename_query_fields(shape, field_names):
+    """Return a copy of a query shape with its top-level filter and sort fields renamed."""
+    return dict(
+        shape,
+        filter={field_names.get(field, field): value for field, value in shape["filter"].items()},
+        sort=[(field_names.get(field, field), direction) for field, direction in shape["sort"]]
+    )
+
+def _index_options(spec):
+    options = {key: value for key, value in spec.items() if key not in ("name", "keys")}
+    options.setdefault("unique", False)
+    return options
+
+def plan_indexes(spec, existing, retired=(), drop_unknown=False):
+    """Return (IndexModels to create, index names to drop).
+
+    `existing` is the output of `index_information()`. Indexes whose keys or
+    options changed are dropped and created again, and `retired` indexes are
+    dropped. Other indexes that are not in the spec are only dropped with
+    `drop_unknown`.
+    """
+    wanted = {index["name"]: index for index in spec}
+    to_create = []
+    to_drop = []
+
+    for name, info in existing.items():
+        if name == "_id_":
+            continue
+        index = wanted.get(name)
+        if index is None:
+            if name in retired or drop_unknown:
+                to_drop.append(name)
+            continue
+        options = _index_options(index)
+        if [tuple(key) for key in info["key"]] != [tuple(key) for key in index["keys"]] or info.get("unique", False) != options["unique"]:
+            to_drop.append(name)
+
+    for name, index in wanted.items():
+        if name not in existing or name in to_drop:
+            to_create.append(IndexModel(index["keys"], name=name, background=True, **_index_options(index)))
+
+    return to_create, to_drop
+
+def unique_index_conflict(spec, error):
+    """Name of the unique index of `spec` that stored duplicates kept from being built, or None.
+
+    Data written before an index became unique can share its keys; building
+    the index then fails with a duplicate key error (code 11000).
+    """
+    if getattr(error, "code", None) != 11000:
+        return None
+    match = re.search(r"index: (\S+) dup key", str(error))
+    if match:
+        return match.group(1)
+    unique = [index for index in spec if index.get("unique")]
+    key_pattern = (getattr(error, "details", None) or {}).get("keyPattern")
+    for index in unique:
+        if key_pattern and list(key_pattern.items()) == [tuple(key) for key in index["keys"]]:
+            return index["name"]
+    return unique[0]["name"] if len(unique) == 1 else None
+
+def without_unique(spec, name):
+    """Copy of `spec` with index `name` built without uniqueness."""
+    return [dict(index, unique=False) if index["name"] == name else index for index in spec]
+
+def collection_scans(explain):
+    """Return the COLLSCAN stages of an explain() result's winning plan."""
+    def walk(stage):
+        if not isinstance(stage, dict):
+            return []
+        found = [stage] if stage.get("stage") == "COLLSCAN" else []
+        for key in ("inputStage", "queryPlan"):
+            found += walk(stage.get(key))
+        for child in stage.get("inputStages", []):
+            found += walk(child)
+        return found
+
+    planner = explain.get("queryPlanner")
+    if planner is None:
+        # Aggregation explains wrap the planner in the $cursor stage.
+        for stage in explain.get("stages", []):
+            if "$cursor" in stage:
+                planner = stage["$cursor"].get("queryPlanner")
+                break
+    if planner is None:
+        return []
+    return walk(planner.get("winningPlan"))
+
+INDEX_STATS_PIPELINE = [
+    {"$indexStats": {}},
+    {"$project": {"_id": 0, "name": 1, "ops": "$accesses.ops", "since": "$accesses.since"}},
+    {"$sort": {"ops": 1}},
+]
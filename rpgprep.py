@@ -1,8 +1,29 @@
+import argparse
 import asyncio
 import os
+import sys
 from pymongo import MongoClient
+from pymongo.errors import OperationFailure
 import aio_pika
 from dotenv import load_dotenv
+from mongo_indexes import (
+    DASHBOARD_INDEXES,
+    DASHBOARD_QUERY_SHAPES,
+    DASHBOARD_VIEW_INDEXES,
+    DASHBOARD_VIEW_QUERY_SHAPES,
+    EVENT_COMPACT_FIELDS,
+    EVENT_INDEXES,
+    EVENT_QUERY_SHAPES,
+    INDEX_STATS_PIPELINE,
+    RETIRED_DASHBOARD_INDEXES,
+    RETIRED_EVENT_INDEXES,
+    collection_scans,
+    plan_indexes,
+    rename_index_fields,
+    rename_query_fields,
+    unique_index_conflict,
+    without_unique,
+)
 
 load_dotenv(override=True)
 
@@ -12,12 +33,16 @@ DATA_PROVIDER_DB = os.getenv("MONGODB_DB", "rgpt")
 DASHBOARD_DB = os.getenv("MONGODB_DB", "rgpt")
 DATA_PROVIDER_COLLECTION = os.getenv("MONGODB_COLLECTION", "providers")
 DASHBOARD_COLLECTION = os.getenv("MONGODB_COLLECTION_DASHBOARD", "dashboard")
+DASHBOARD_VIEW_COLLECTION = os.getenv("MONGODB_COLLECTION_DASHBOARD_VIEW", "dashboard_view")
+EVENTS_COMPACT_FIELDS = os.getenv("EVENTS_COMPACT_FIELDS", "false").lower() == "true"
+EVENT_FIELD_NAMES = EVENT_COMPACT_FIELDS if EVENTS_COMPACT_FIELDS else {}
 
 print(f"MONGODB_URL: {MONGODB_URL}")
 print(f"DATA_PROVIDER_DB: {DATA_PROVIDER_DB}")
 print(f"DASHBOARD_DB: {DASHBOARD_DB}")
 print(f"DATA_PROVIDER_COLLECTION: {DATA_PROVIDER_COLLECTION}")
 print(f"DASHBOARD_COLLECTION: {DASHBOARD_COLLECTION}")
+print(f"DASHBOARD_VIEW_COLLECTION: {DASHBOARD_VIEW_COLLECTION}")
 
 # RabbitMQ configuration
 RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "localhost")
@@ -27,8 +52,14 @@ RABBITMQ_PORT = int(os.getenv("RABBITMQ_PORT", 5672))
 RABBITMQ_EXCHANGE = os.getenv("RABBITMQ_EXCHANGE", "blankon_exchange")
 RABBITMQ_ROUTING_KEY = os.getenv("RABBITMQ_ROUTING_KEY", "blankon_key")
 RABBITMQ_QUEUE = os.getenv("RABBITMQ_QUEUE", "blankon_queue")
+RABBITMQ_EVENTS_EXCHANGE = os.getenv("RABBITMQ_EVENTS_EXCHANGE", "blankon_events")
+CONSUMER_PARTITIONS = int(os.getenv("CONSUMER_PARTITIONS", 1))
 
-async def setup_mongodb():
+def partition_name(name, partition):
+    # Same naming as RabbitMQBroker.partition_name in the Data Provider.
+    return name if CONSUMER_PARTITIONS <= 1 else f"{name}.{partition}"
+
+async def setup_mongodb(drop_unknown=False):
     client = MongoClient(MONGODB_URL)
     
     # Set up Data Provider database and collection
@@ -42,9 +73,69 @@ async def setup_mongodb():
     if DASHBOARD_COLLECTION not in dash_db.list_collection_names():
         dash_db.create_collection(DASHBOARD_COLLECTION)
     print(f"Created collection: {DASHBOARD_COLLECTION} in database: {DASHBOARD_DB}")
+    if DASHBOARD_VIEW_COLLECTION not in dash_db.list_collection_names():
+        dash_db.create_collection(DASHBOARD_VIEW_COLLECTION)
+    print(f"Created collection: {DASHBOARD_VIEW_COLLECTION} in database: {DASHBOARD_DB}")
+
+    if "id" in ensure_indexes(dp_db[DATA_PROVIDER_COLLECTION], rename_index_fields(EVENT_INDEXES, EVENT_FIELD_NAMES), RETIRED_EVENT_INDEXES, drop_unknown):
+        print("Stored events share ids, run Data-Provider-Service/database/migrate_events.py --dedupe-ids to make the id index unique")
+    ensure_indexes(dash_db[DASHBOARD_COLLECTION], DASHBOARD_INDEXES, RETIRED_DASHBOARD_INDEXES, drop_unknown)
+    ensure_indexes(dash_db[DASHBOARD_VIEW_COLLECTION], DASHBOARD_VIEW_INDEXES, drop_unknown=drop_unknown)
     
     client.close()
 
+def ensure_indexes(collection, spec, retired=(), drop_unknown=False):
+    """Apply an index spec; returns the unique indexes stored duplicates forced to build without uniqueness."""
+    to_create, to_drop = plan_indexes(spec, collection.index_information(), retired, drop_unknown)
+    for name in to_drop:
+        print(f"Dropping index {name} on {collection.name}")
+        collection.drop_index(name)
+    if not to_create:
+        print(f"Indexes of {collection.name} are up to date")
+        return []
+    print(f"Creating indexes on {collection.name}: {', '.join(index.document['name'] for index in to_create)}")
+    try:
+        collection.create_indexes(to_create)
+    except OperationFailure as e:
+        name = unique_index_conflict(spec, e)
+        if name is None:
+            raise
+        print(f"Stored documents of {collection.name} share keys of unique index {name}, building it without uniqueness")
+        return [name] + ensure_indexes(collection, without_unique(spec, name), retired, drop_unknown)
+    return []
+
+def collections_with_shapes(client):
+    return [
+        (client[DATA_PROVIDER_DB][DATA_PROVIDER_COLLECTION], [rename_query_fields(shape, EVENT_FIELD_NAMES) for shape in EVENT_QUERY_SHAPES]),
+        (client[DASHBOARD_DB][DASHBOARD_COLLECTION], DASHBOARD_QUERY_SHAPES),
+        (client[DASHBOARD_DB][DASHBOARD_VIEW_COLLECTION], DASHBOARD_VIEW_QUERY_SHAPES),
+    ]
+
+def report_index_usage():
+    client = MongoClient(MONGODB_URL)
+    for collection, _ in collections_with_shapes(client):
+        print(f"Index usage for {collection.name}:")
+        for stats in collection.aggregate(INDEX_STATS_PIPELINE):
+            print(f"  {stats['name']}: {stats['ops']} ops since {stats['since']}")
+    client.close()
+
+def check_query_plans():
+    client = MongoClient(MONGODB_URL)
+    failures = 0
+    for collection, shapes in collections_with_shapes(client):
+        for shape in shapes:
+            cursor = collection.find(shape["filter"])
+            if shape["sort"]:
+                cursor = cursor.sort(shape["sort"])
+            explain = cursor.explain()
+            if collection_scans(explain):
+                failures += 1
+                print(f"COLLSCAN  {collection.name}: {shape['name']} {shape['filter']}")
+            else:
+                print(f"indexed   {collection.name}: {shape['name']}")
+    client.close()
+    return failures
+
 async def setup_rabbitmq():
     max_retries = 5
     retry_delay = 5  # seconds
@@ -64,13 +155,24 @@ async def setup_rabbitmq():
                 )
                 print(f"Declared exchange: {RABBITMQ_EXCHANGE}")
 
-                # Declare queue
-                queue = await channel.declare_queue(RABBITMQ_QUEUE, durable=True)
-                print(f"Declared queue: {RABBITMQ_QUEUE}")
+                # Declare one queue per partition and bind it to its routing key
+                for partition in range(max(CONSUMER_PARTITIONS, 1)):
+                    queue_name = partition_name(RABBITMQ_QUEUE, partition)
+                    routing_key = partition_name(RABBITMQ_ROUTING_KEY, partition)
+                    queue = await channel.declare_queue(
+                        queue_name,
+                        durable=True,
+                        arguments={"x-single-active-consumer": True} if CONSUMER_PARTITIONS > 1 else None
+                    )
+                    print(f"Declared queue: {queue_name}")
+                    await queue.bind(exchange, routing_key=routing_key)
+                    print(f"Bound queue {queue_name} to exchange {RABBITMQ_EXCHANGE} with routing key {routing_key}")
 
-                # Bind queue to exchange with routing key
-                await queue.bind(exchange, routing_key=RABBITMQ_ROUTING_KEY)
-                print(f"Bound queue {RABBITMQ_QUEUE} to exchange {RABBITMQ_EXCHANGE} with routing key {RABBITMQ_ROUTING_KEY}")
+                # Declare the topic exchange stored events are fanned out on
+                await channel.declare_exchange(
+                    RABBITMQ_EVENTS_EXCHANGE, aio_pika.ExchangeType.TOPIC, durable=True
+                )
+                print(f"Declared exchange: {RABBITMQ_EVENTS_EXCHANGE}")
 
             return  # Successfully connected and set up RabbitMQ
         except Exception as e:
@@ -82,9 +184,9 @@ async def setup_rabbitmq():
                 print("Max retries reached. Failed to set up RabbitMQ.")
                 raise
 
-async def main():
+async def main(drop_unknown=False):
     print("Setting up MongoDB...")
-    await setup_mongodb()
+    await setup_mongodb(drop_unknown)
     
     print("\nSetting up RabbitMQ...")
     await setup_rabbitmq()
@@ -92,4 +194,15 @@ async def main():
     print("\nSetup complete!")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Prepare MongoDB and RabbitMQ for the services.")
+    parser.add_argument("--index-stats", action="store_true", help="Print $indexStats usage counters and exit")
+    parser.add_argument("--check-indexes", action="store_true", help="Explain the hot queries and fail if any of them scans the collection")
+    parser.add_argument("--drop-unknown-indexes", action="store_true", help="Also drop indexes that are not in mongo_indexes.py, such as ones added by hand")
+    args = parser.parse_args()
+
+    if args.index_stats:
+        report_index_usage()
+    elif args.check_indexes:
+        sys.exit(1 if check_query_plans() else 0)
+    else:
+        asyncio.run(main(args.drop_unknown_indexes))
\ No newline at end of file